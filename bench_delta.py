@@ -0,0 +1,84 @@
+from rit.pack import apply_delta
+
+import argparse
+import random
+import time
+
+
+def encode_size(n):
+    out = bytearray()
+    while 1:
+        cur = n & 0x7f
+        n >>= 7
+        if n:
+            out.append(cur | 0x80)
+        else:
+            out.append(cur)
+            return bytes(out)
+
+
+def copy_op(offset, n):
+    inst = 0x80
+    args = bytearray()
+    for i in range(4):
+        byte = (offset >> (8*i)) & 0xff
+        if byte:
+            inst |= 1 << i
+            args.append(byte)
+    for i in range(3):
+        byte = (n >> (8*i)) & 0xff
+        if byte:
+            inst |= 1 << (4+i)
+            args.append(byte)
+    return bytes([inst]) + bytes(args)
+
+
+def make_delta(rng, base, size, max_copy, max_insert):
+    ops = []
+    expected = []
+    out = 0
+    while out < size:
+        if rng.random() < 0.8:
+            n = min(rng.randint(1, max_copy), size - out)
+            offset = rng.randint(0, len(base) - n)
+            ops.append(copy_op(offset, n))
+            expected.append(base[offset:offset+n])
+        else:
+            n = min(rng.randint(1, max_insert), size - out)
+            data = rng.randbytes(n)
+            ops.append(bytes([n]) + data)
+            expected.append(data)
+        out += n
+    delta = encode_size(len(base)) + encode_size(size) + b''.join(ops)
+    return delta, b''.join(expected)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--base-size", type=int, default=16 << 20)
+    parser.add_argument("--size", type=int, default=32 << 20)
+    parser.add_argument("--max-copy", type=int, default=0xffff)
+    parser.add_argument("--max-insert", type=int, default=0x7f)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    base = rng.randbytes(args.base_size)
+    delta, expected = make_delta(
+            rng, base, args.size, args.max_copy, args.max_insert)
+    if apply_delta(delta, base) != expected:
+        raise SystemExit("apply_delta produced the wrong result")
+
+    times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        apply_delta(delta, base)
+        times.append(time.perf_counter() - start)
+    best = min(times)
+    print(f"delta: {len(delta)} bytes, result: {len(expected)} bytes")
+    print(f"best of {args.repeat}: {best:.3f}s ({len(expected) / best / (1 << 20):.1f} MiB/s)")
+
+
+if __name__ == '__main__':
+    main()
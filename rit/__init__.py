@@ -1,6 +1,13 @@
-from rit.index import IndexWrapper, TreeEntry, ExtensionEntry, Tree
-from rit.pack import PackParser, IndexParser
+from rit.index import IndexWrapper
+from rit.pack import PackParser, PackIndexer, open_index
 from rit.objects import ObjectParser
+from rit.loose import ObjectWriter
+from rit.refs import ref_store
+from rit.worktree import unstaged_changes, untracked_files, stage_paths
+from rit import fsmonitor
+from rit.commitgraph import write_commit_graph
+from rit.revwalk import walk, parse_date
+from rit.pktline import demux
 from rit.color import yellow, green
 from collections import OrderedDict
 
@@ -8,10 +15,11 @@ import urllib.request
 import argparse
 import binascii
 import hashlib
+import mmap
 import os
+import shutil
 import sys
 import time
-import zlib
 
 
 __version__ = "0.0.0"
@@ -38,23 +46,10 @@ if gitexists:
 
 def write_tree():
     iw = IndexWrapper()
-    i = iw.index
-    root = Tree()
-    for e in i.entries:
-        root.add(e)
-    trees = []
-    for name, t in root.iter():
-        ec = t.entry_count
-        sc = len(t['dirs'])
-        h,z = t.hash()
-        write_object(h, z)
-        te = TreeEntry(name, ec, sc, h)
-        trees.append(te)
-    ee = ExtensionEntry(b'TREE', trees)
-    i.set_ext(ee)
-    iw.write()
-
-    h,_ = root.hash()
+    with ObjectWriter() as w:
+        h, changed = iw.index.cache_tree(w)
+    if changed:
+        iw.write()
     return binascii.hexlify(h).decode()
 
 def hash_blob(fname):
@@ -64,16 +59,15 @@ def hash_blob(fname):
     blob = f"blob {length}".encode()
     blob += b"\x00"
     blob += data
-    zipped = zlib.compress(blob)
     h = hashlib.sha1(blob).digest()
-    return h, zipped
+    return h, blob
 
 
 def hash_object(fname, write=False):
-    h,z = hash_blob(fname)
+    h,blob = hash_blob(fname)
 
     if write:
-        write_object(h, z)
+        write_object(h, blob, raw=True)
     return binascii.hexlify(h).decode()
 
 
@@ -95,24 +89,14 @@ def commit_tree(msg, tree, parent=''):
     commit = f"commit {length}".encode()
     commit += b"\x00"
     commit += data
-    zipped = zlib.compress(commit)
     h = hashlib.sha1(commit).digest()
-    write_object(h, zipped)
+    write_object(h, commit, raw=True)
     return binascii.hexlify(h).decode()
 
 
-def write_object(_h, zipped):
-    h = binascii.hexlify(_h).decode()
-    path = f".git/objects/{h[:2]}/{h[2:]}"
-    dirname = os.path.dirname(path)
-
-    if not os.path.isdir(dirname):
-        os.mkdir(dirname)
-    if os.path.isfile(path):
-        os.chmod(path, 0o644)
-    with open(path, "wb") as f:
-        f.write(zipped)
-    os.chmod(path, 0o444)
+def write_object(h, data, raw=False):
+    with ObjectWriter() as w:
+        w.write(h, data, raw=raw)
 
 
 def cur_objects():
@@ -141,44 +125,58 @@ def update_index(mode, hsh, filename):
     i.write()
 
 
+def set_index_format(ver=None, split=None):
+    i = IndexWrapper()
+    if ver:
+        i.index.ver = ver
+    i.write(split=split)
+
+
 def update_ref(ref, hsh):
-    path = os.path.join(git, ref)
-    dirname = os.path.dirname(path)
-    if not os.path.isdir(dirname):
-        os.makedirs(dirname)
-    with open(f".git/{ref}", 'w') as f:
-        f.write(hsh + '\n')
+    ref_store().update(ref, hsh)
 
 
-def add(fname):
+def add(fnames, everything=False):
     relative = here[len(gitdir):].lstrip('/')
-    fn = os.path.join(relative, fname)
-    h = hash_object(fn, write=True)
     i = IndexWrapper()
-    i.add_entry(0o100644, binascii.unhexlify(h), fn)
-    i.write()
+    files = []
+    dirs = [''] if everything else []
+    for fname in fnames:
+        fn = os.path.normpath(os.path.join(relative, fname))
+        if fn == '.':
+            fn = ''
+        if fn and os.path.lexists(fn) and not os.path.isdir(fn):
+            files.append(fn)
+        elif not fn or os.path.isdir(fn):
+            dirs.append(fn)
+        elif any(name == fn.encode() or name.startswith(fn.encode() + b'/') for name in i.index.names):
+            dirs.append(fn)
+        else:
+            print(f"fatal: pathspec '{fname}' did not match any files")
+            return
+    changed = None
+    if dirs:
+        token, changed = fsmonitor.query(fsmonitor.index_token(i.index))
+        if token is not None and changed is not None:
+            changed |= fsmonitor.index_dirty(i.index)
+    with ObjectWriter() as w:
+        modified = stage_paths(i, files, dirs, w, changed=changed)
+    if modified:
+        i.write()
 
 
 def head():
-    with open(".git/HEAD") as f:
-        data = f.read()
-        ref = data.split(':')[1].strip()
-    return ref
+    return ref_store().head()
 
 
 def rev_parse(ref):
-    path = f".git/{ref}"
-    if os.path.isfile(path):
-        with open(f".git/{ref}") as f:
-            return f.read().strip()
-    return ''
+    return ref_store().resolve(ref)
 
 
 def commit(msg):
-    h = write_tree()
+    tree = write_tree()
     ref = head()
     parent = rev_parse(ref)
-    tree = write_tree()
     hsh = commit_tree(msg, tree, parent)
     update_ref(ref, hsh)
 
@@ -192,13 +190,10 @@ def checkout(b, new=None):
 
 
 def change_branch(b):
-    ref = f"refs/heads/{b}"
-    path = f".git/{ref}"
-    if not os.path.isfile(path):
+    if not is_branch(b):
         print(f"Branch {b} does not exist")
         return
-    with open(".git/HEAD", "w") as f:
-        f.write(f"ref: {ref}")
+    ref_store().set_head(f"refs/heads/{b}")
 
 
 def branch(b, delete=None):
@@ -232,10 +227,7 @@ def create_branch(b):
 
 def is_branch(b):
     ref = f"refs/heads/{b}"
-    path = os.path.join(gitdir, git, ref)
-    if os.path.isfile(path):
-        return True
-    return False
+    return bool(ref_store().resolve(ref))
 
 
 def delete_branch(b):
@@ -244,16 +236,12 @@ def delete_branch(b):
     if ref == curref:
         print(f"error: Cannot delete checked out branch '{b}'")
         return
-    path = os.path.join(gitdir, git, ref)
-    try:
-        os.remove(path)
-    except:
+    if not ref_store().delete(ref):
         print(f"error: branch '{b}' not found")
 
 
 def get_branches():
-    path = os.path.join(gitdir, git, 'refs', 'heads')
-    return sorted(os.listdir(path))
+    return ref_store().branches()
 
 
 def init():
@@ -272,7 +260,7 @@ def init():
         f.write("ref: refs/heads/master\n")
 
 
-def clone(repo):
+def clone(repo, keep_pack=False):
     if gitexists:
         print("Already in git repo")
         return
@@ -286,8 +274,8 @@ def clone(repo):
     init()
     hsh = http_transfer_meta(repo)
     path = http_transfer(repo, hsh)
-    index_pack(path, show=False)
-    unpack_objects(path)
+    if not keep_pack:
+        unpack_objects(path)
     ref = head()
     update_ref(ref, hsh)
     set_working_commit(hsh)
@@ -330,66 +318,85 @@ def http_transfer(repo, hsh):
     req = urllib.request.Request(url, body)
     req.add_header("Content-Type", "application/x-git-upload-pack-request")
 
-    r = urllib.request.urlopen(req)
-    data = r.read()
+    dirname = os.path.join(git, 'objects', 'pack')
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
 
-    packdata = b''
-    while 1:
-        i,data = data[:4], data[4:]
-        n = int(i, 16)-4
-        msg,data = data[:n], data[n:]
-    
-        try:
-            if msg[0] == 2:
-                sys.stdout.write(msg[1:].decode())
-            elif msg[0] == 1:
-                packdata += msg[1:]
+    pi = PackIndexer(dirname)
+    try:
+        with urllib.request.urlopen(req) as r:
+            demux(r, pi)
+        return pi.finish(fix_thin=True)
+    except BaseException:
+        pi.abort()
+        raise
 
-        except:
-            break
 
+def index_pack_stdin(show=True, fix_thin=False):
     dirname = os.path.join(git, 'objects', 'pack')
     if not os.path.isdir(dirname):
         os.makedirs(dirname)
-    
-    h = binascii.hexlify(packdata[-20:]).decode()
-    path = os.path.join(git, 'objects', 'pack', f'pack-{h}.pack')
-    with open(path, 'wb') as f:
-        f.write(packdata)
-    return path
+    pi = PackIndexer(dirname)
+    try:
+        while 1:
+            chunk = sys.stdin.buffer.read(65536)
+            if not chunk:
+                break
+            pi.write(chunk)
+        pi.finish(fix_thin=fix_thin)
+    except ValueError as e:
+        pi.abort()
+        print(f"fatal: {e}")
+        return
+    except BaseException:
+        pi.abort()
+        raise
+    if show:
+        print(binascii.hexlify(pi.tail).decode())
 
 
-def index_pack(packfile, show=True):
+def index_pack(packfile, show=True, threads=1):
     os.chdir(here)
     if not os.path.isfile(packfile):
         print(f"fatal: cannot open packfile '{packfile}': No such file or directory")
         return
     with open(packfile, 'rb') as f:
-        data = f.read()
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
     p = PackParser(data)
-    p.parse_without_index()
-    index = p.create_index()
+    if threads > 1:
+        p.parse_parallel(packfile, threads)
+    else:
+        p.parse_without_index()
+    index = p.write_index(packfile)
     sha = index[-40:-20]
     #print(sha)
     if show:
         print(binascii.hexlify(sha).decode())
-    base = os.path.splitext(packfile)[0]
-    path = '.'.join((base, 'idx'))
-    with open(path, 'wb') as f:
-        f.write(index)
 
 
-def unpack_objects(packfile):
+def unpack_objects(packfile, keep_pack=False):
     base = os.path.splitext(packfile)[0]
     idxfile = '.'.join((base, 'idx'))
-    with open(idxfile, 'rb') as f:
-        ip = IndexParser(f.read())
-    idx = ip.parse()
+    idx = open_index(idxfile)
+    objdir = os.path.join(git, 'objects')
+
+    if keep_pack:
+        packdir = os.path.join(objdir, 'pack')
+        if not os.path.isdir(packdir):
+            os.makedirs(packdir)
+        h = binascii.hexlify(idx.pack_sha).decode()
+        dest = os.path.join(packdir, f'pack-{h}')
+        for ext in ('pack', 'idx', 'rev'):
+            src = '.'.join((base, ext))
+            dst = '.'.join((dest, ext))
+            if os.path.isfile(src) and not os.path.isfile(dst):
+                shutil.copyfile(src, dst)
+                os.chmod(dst, 0o444)
+        return
 
     with open(packfile, 'rb') as f:
-        p = PackParser(f.read(), index=idx)
-    p.parse_without_index()
-    objdir = os.path.join(git, 'objects')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    p = PackParser(data, index=idx)
     p.write_objects(objdir)
 
 
@@ -449,48 +456,56 @@ def add_remote(name, url):
 
 
 def all_refs():
-    os.chdir(gitdir)
-    refdir = os.path.join(git, 'refs')
-    heads_path = os.path.join(git, 'refs', 'heads')
-    remotes_path = os.path.join(git, 'refs', 'remotes')
+    store = ref_store()
     refs = {}
-    for dname, dirs, files in os.walk(refdir):
-        for fname in files:
-            full = os.path.join(dname, fname)
-            hsh = rev_parse(full[len(git):])
-            if os.path.commonpath((full, heads_path)) == heads_path:
-                key = full[len(heads_path):].lstrip('/')
-            elif os.path.commonpath((full, remotes_path)) == remotes_path:
-                key = full[len(remotes_path):].lstrip('/')
-            refs[hsh] = refs.get(hsh, []) + [key]
+    for name in sorted(store.refs()):
+        hsh = store.peeled(name)
+        if name.startswith('refs/heads/'):
+            key = name[len('refs/heads/'):]
+        elif name.startswith('refs/remotes/'):
+            key = name[len('refs/remotes/'):]
+        elif name.startswith('refs/tags/'):
+            key = 'tag: ' + name[len('refs/tags/'):]
+        else:
+            key = name
+        refs.setdefault(hsh, []).append(key)
     return refs
 
 
-def log(oneline):
+def pack_refs(everything=False):
+    ref_store().pack(everything=everything)
+
+
+def commit_graph_write():
+    tips = set(all_refs())
+    tips.add(rev_parse(head()))
+    tips.discard('')
+    write_commit_graph(tips)
+
+
+def log(oneline, max_count=None, since=None, until=None, first_parent=False):
     refs = all_refs()
     h = head()
     ref = rev_parse(h)
-    stack = [ref]
-    while stack:
-        ref = stack[0]
-        del stack[0]
-
-        op = ObjectParser(ref)
-        commit = op.parse()
-        if oneline:
-            print(yellow(commit.hash[:8]), end=' ')
-            print(commit.message.decode().split('\n')[0])
-        else:
-            print(yellow(commit.hash), end=' ')
-            if commit.hash in refs:
-                print("(", end='')
-                print(', '.join(refs[commit.hash]), end='')
-                print(')')
-            print()
-            print(commit.message.decode())
-            print()
-        stack = commit.parents + stack
-        #ref = commit.parents[0]
+    out = sys.stdout.buffer
+    sys.stdout.flush()
+    commits = walk([ref], limit=max_count, since=since, until=until,
+            first_parent=first_parent)
+    try:
+        for hsh in commits:
+            commit = ObjectParser(hsh).parse()
+            if oneline:
+                line = commit.message.decode().split('\n')[0]
+                out.write(f"{yellow(commit.hash[:8])} {line}\n".encode())
+            else:
+                text = yellow(commit.hash) + ' '
+                if commit.hash in refs:
+                    text += '(' + ', '.join(refs[commit.hash]) + ')\n'
+                text += '\n' + commit.message.decode() + '\n\n'
+                out.write(text.encode())
+        out.flush()
+    except BrokenPipeError:
+        sys.stdout = None
 
 
 def to_be_committed():
@@ -511,20 +526,17 @@ def to_be_committed():
     return results
 
 
-def not_staged():
-    # Need to parse gitignore and do regex :(
+def not_staged(iw=None, changed=None, token=None):
     os.chdir(gitdir)
-    for dirname, dirs, files in os.walk('.'):
-        for f in files:
-            full = os.path.join(dirname, f)[2:]
-            if full.startswith(".git/"):
-                continue
-            #print(full)
+    return unstaged_changes(iw, changed=changed, token=token)
 
 
-
-def untracked():
-    pass
+def untracked(iw=None, changed=None):
+    os.chdir(gitdir)
+    tracked = None
+    if iw is not None:
+        tracked = {e.entry_path_name.decode() for e in iw.index.entries}
+    return untracked_files(tracked, changed=changed)
 
 
 def status():
@@ -542,18 +554,21 @@ def status():
             print(green(f"        {s}:   {c}"))
         print()
 
-    ns = not_staged()
+    os.chdir(gitdir)
+    iw = IndexWrapper()
+    token, paths = fsmonitor.query(fsmonitor.index_token(iw.index))
+    ns = not_staged(iw, paths, token)
     if ns:
         changed = True
         print("Changes not staged for commit:")
         print('  (use "git add <file>..." to update what will be committed)')
         print('  (use "git checkout -- <file>..." to discard changes in working directory)')
         print()
-        for s in ns:
-            print(f"        modified:   {s}")
+        for s,c in ns:
+            print(f"        {s}:   {c}")
         print()
 
-    uf = untracked()
+    uf = untracked(iw, paths)
     if uf:
         changed = True
         print("Untracked files:")
@@ -603,12 +618,16 @@ def main():
     cf.add_argument("-t")
 
     ui = subparsers.add_parser("update-index")
-    ui.add_argument("mode")
-    ui.add_argument("hash")
-    ui.add_argument("filename")
+    ui.add_argument("mode", nargs='?')
+    ui.add_argument("hash", nargs='?')
+    ui.add_argument("filename", nargs='?')
+    ui.add_argument("--index-version", type=int, choices=[2, 3, 4])
+    ui.add_argument("--split-index", action="store_true", default=None)
+    ui.add_argument("--no-split-index", dest="split_index", action="store_false")
 
     ad = subparsers.add_parser("add")
-    ad.add_argument("filename")
+    ad.add_argument("filename", nargs='*')
+    ad.add_argument("-A", "--all", action="store_true")
 
     cm = subparsers.add_parser("commit")
     cm.add_argument("--message", "-m", required=True)
@@ -634,17 +653,35 @@ def main():
 
     st = subparsers.add_parser("status")
 
+    fm = subparsers.add_parser("fsmonitor")
+    fm.add_argument("monitor_action", choices=["start", "stop", "status", "run"])
+
     cl = subparsers.add_parser("clone")
     cl.add_argument("repo")
+    cl.add_argument("--keep-pack", action="store_true")
 
     ip = subparsers.add_parser("index-pack")
-    ip.add_argument("packfile")
+    ip.add_argument("packfile", nargs='?')
+    ip.add_argument("--stdin", action="store_true")
+    ip.add_argument("--fix-thin", action="store_true")
+    ip.add_argument("--threads", type=int, default=1)
 
     uo = subparsers.add_parser("unpack-objects")
     uo.add_argument("packfile")
+    uo.add_argument("--keep-pack", action="store_true")
+
+    pr = subparsers.add_parser("pack-refs")
+    pr.add_argument("--all", action="store_true")
+
+    cg = subparsers.add_parser("commit-graph")
+    cg.add_argument("graph_action", choices=["write"])
 
     lg = subparsers.add_parser("log")
     lg.add_argument("--oneline", action="store_true")
+    lg.add_argument("-n", "--max-count", type=int)
+    lg.add_argument("--since", "--after", type=parse_date)
+    lg.add_argument("--until", "--before", type=parse_date)
+    lg.add_argument("--first-parent", action="store_true")
 
     rm = subparsers.add_parser("remote")
     rm_subparsers = rm.add_subparsers(dest="remote_action")
@@ -668,10 +705,19 @@ def main():
         elif args.t:
             print(cat_file(args.t, type_only=True).decode())
     elif action == "update-index":
-        update_index(args.mode, args.hash, args.filename)
+        entry = (args.mode, args.hash, args.filename)
+        reformat = args.index_version or args.split_index is not None
+        if any(entry) and not all(entry):
+            ui.error("mode, hash and filename must be given together")
+        if not any(entry) and not reformat:
+            ui.error("expected mode, hash and filename")
+        if reformat:
+            set_index_format(args.index_version, args.split_index)
+        if all(entry):
+            update_index(int(args.mode, 8), args.hash, args.filename)
         
     elif action == "add":
-        add(args.filename)
+        add(args.filename, everything=args.all)
 
     elif action == "commit":
         commit(args.message)
@@ -698,14 +744,23 @@ def main():
     elif action == "status":
         status()
 
+    elif action == "fsmonitor":
+        os.chdir(gitdir)
+        getattr(fsmonitor, args.monitor_action)()
+
     elif action == "clone":
-        clone(args.repo)
+        clone(args.repo, keep_pack=args.keep_pack)
 
     elif action == "index-pack":
-        index_pack(args.packfile)
+        if not args.stdin and args.packfile is None:
+            ip.error("expected a packfile or --stdin")
+        if args.stdin:
+            index_pack_stdin(fix_thin=args.fix_thin)
+        else:
+            index_pack(args.packfile, threads=args.threads)
 
     elif action == "unpack-objects":
-        unpack_objects(args.packfile)
+        unpack_objects(args.packfile, keep_pack=args.keep_pack)
 
     elif action == "remote":
         if args.remote_action == "add":
@@ -713,8 +768,16 @@ def main():
         elif args.remote_action == "remove":
             pass
 
+    elif action == "pack-refs":
+        pack_refs(everything=args.all)
+
+    elif action == "commit-graph":
+        if args.graph_action == "write":
+            commit_graph_write()
+
     elif action == "log":
-        log(args.oneline)
+        log(args.oneline, max_count=args.max_count, since=args.since,
+                until=args.until, first_parent=args.first_parent)
 
     else:
         parser.print_help()
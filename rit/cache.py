@@ -0,0 +1,47 @@
+from collections import OrderedDict
+
+
+class LRUCache:
+    def __init__(self, budget):
+        self.budget = budget
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, key):
+        return key in self.items
+
+    def get(self, key):
+        item = self.items.get(key)
+        if item is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.items.move_to_end(key)
+        return item[0]
+
+    def put(self, key, value, size):
+        if size > self.budget:
+            return
+        old = self.items.pop(key, None)
+        if old is not None:
+            self.size -= old[1]
+        self.items[key] = (value, size)
+        self.size += size
+        while self.size > self.budget:
+            _,(_,evicted) = self.items.popitem(last=False)
+            self.size -= evicted
+
+    def clear(self):
+        self.items.clear()
+        self.size = 0
+
+    def ratio(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
@@ -0,0 +1,180 @@
+from rit.objects import ObjectParser
+from rit.lockfile import write_locked
+
+import binascii
+import bisect
+import hashlib
+import mmap
+import os
+import struct
+
+
+GRAPH_PATH = os.path.join('.git', 'objects', 'info', 'commit-graph')
+
+NO_PARENT = 0x70000000
+EXTRA_EDGES = 0x80000000
+
+
+class CommitGraph:
+    chunk_s = struct.Struct(">4sQ")
+    fanout_s = struct.Struct(">256I")
+    cdat_s = struct.Struct(">20sIIQ")
+    word = struct.Struct(">I")
+
+    def __init__(self, data):
+        self.data = data
+        if data[:4] != b'CGPH' or data[4] != 1 or data[5] != 1:
+            raise ValueError("Unsupported commit-graph version")
+        nchunks = data[6]
+        chunks = {}
+        for i in range(nchunks):
+            cid, start = self.chunk_s.unpack_from(data, 8 + 12*i)
+            chunks[cid] = start
+        self.fanout = self.fanout_s.unpack_from(data, chunks[b'OIDF'])
+        self.num = self.fanout[255]
+        self.oidl = chunks[b'OIDL']
+        self.cdat = chunks[b'CDAT']
+        self.edge = chunks.get(b'EDGE')
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, i):
+        start = self.oidl + 20*i
+        return bytes(self.data[start:start+20])
+
+    def lookup(self, sha):
+        first = sha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        i = bisect.bisect_left(self, sha, lo, hi)
+        if i < hi and self[i] == sha:
+            return i
+        return None
+
+    def commit(self, i):
+        tree, p1, p2, gd = self.cdat_s.unpack_from(self.data, self.cdat + 36*i)
+        parents = []
+        if p1 != NO_PARENT:
+            parents.append(p1)
+        if p2 & EXTRA_EDGES:
+            pos = self.edge + 4*(p2 & ~EXTRA_EDGES)
+            while 1:
+                edge = self.word.unpack_from(self.data, pos)[0]
+                parents.append(edge & ~EXTRA_EDGES)
+                if edge & EXTRA_EDGES:
+                    break
+                pos += 4
+        elif p2 != NO_PARENT:
+            parents.append(p2)
+        return tree, parents, gd >> 34, gd & (2**34 - 1)
+
+    def parents(self, hsh):
+        i = self.lookup(binascii.unhexlify(hsh))
+        if i is None:
+            return None
+        _, parents, _, _ = self.commit(i)
+        return [binascii.hexlify(self[p]).decode() for p in parents]
+
+    def date(self, hsh):
+        i = self.lookup(binascii.unhexlify(hsh))
+        if i is None:
+            return None
+        return self.commit(i)[3]
+
+    def generation(self, hsh):
+        i = self.lookup(binascii.unhexlify(hsh))
+        if i is None:
+            return None
+        return self.commit(i)[2]
+
+
+_graph = None
+
+
+def load_commit_graph(path=GRAPH_PATH):
+    global _graph
+    if _graph is None and os.path.isfile(path):
+        with open(path, 'rb') as f:
+            _graph = CommitGraph(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
+    return _graph
+
+
+def write_commit_graph(tips, path=GRAPH_PATH):
+    commits = {}
+    stack = list(tips)
+    while stack:
+        hsh = stack.pop()
+        if hsh in commits:
+            continue
+        c = ObjectParser(hsh).parse()
+        if c is None or c.type != b'commit':
+            continue
+        commits[hsh] = (binascii.unhexlify(c.tree), c.parents, c.date)
+        stack += c.parents
+
+    generations = {}
+    for hsh in commits:
+        stack = [hsh]
+        while stack:
+            cur = stack[-1]
+            if cur in generations:
+                stack.pop()
+                continue
+            todo = [p for p in commits[cur][1] if p not in generations]
+            if todo:
+                stack += todo
+                continue
+            parents = commits[cur][1]
+            generations[cur] = 1 + max((generations[p] for p in parents), default=0)
+            stack.pop()
+
+    oids = sorted(binascii.unhexlify(h) for h in commits)
+    pos = {binascii.hexlify(sha).decode(): i for i, sha in enumerate(oids)}
+    counts = [0]*256
+    for sha in oids:
+        counts[sha[0]] += 1
+
+    oidf = bytearray()
+    total = 0
+    for count in counts:
+        total += count
+        oidf += struct.pack(">I", total)
+    oidl = b''.join(oids)
+    cdat = bytearray()
+    edge = bytearray()
+    for sha in oids:
+        hsh = binascii.hexlify(sha).decode()
+        tree, parents, date = commits[hsh]
+        parents = [pos[p] for p in parents]
+        p1 = parents[0] if parents else NO_PARENT
+        if len(parents) > 2:
+            p2 = EXTRA_EDGES | (len(edge) // 4)
+            for i, p in enumerate(parents[1:], 2):
+                if i == len(parents):
+                    p |= EXTRA_EDGES
+                edge += struct.pack(">I", p)
+        elif len(parents) == 2:
+            p2 = parents[1]
+        else:
+            p2 = NO_PARENT
+        cdat += CommitGraph.cdat_s.pack(tree, p1, p2, generations[hsh] << 34 | date)
+
+    chunks = [(b'OIDF', oidf), (b'OIDL', oidl), (b'CDAT', cdat)]
+    if edge:
+        chunks.append((b'EDGE', edge))
+    data = bytearray(b'CGPH' + bytes([1, 1, len(chunks), 0]))
+    start = len(data) + 12*(len(chunks) + 1)
+    for cid, chunk in chunks:
+        data += CommitGraph.chunk_s.pack(cid, start)
+        start += len(chunk)
+    data += CommitGraph.chunk_s.pack(b'\x00'*4, start)
+    for _, chunk in chunks:
+        data += chunk
+    data += hashlib.sha1(data).digest()
+
+    dirname = os.path.dirname(path)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    write_locked(path, data)
+    return len(oids)
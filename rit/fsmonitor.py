@@ -0,0 +1,280 @@
+import ctypes
+import ctypes.util
+import errno
+import os
+import selectors
+import signal
+import socket
+import struct
+import sys
+
+
+SOCKET_PATH = os.path.join('.git', 'fsmonitor.sock')
+PID_PATH = os.path.join('.git', 'fsmonitor.pid')
+JOURNAL_MAX = 1 << 20
+
+IN_MODIFY = 0x2
+IN_ATTRIB = 0x4
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_FROM = 0x40
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+IN_DELETE_SELF = 0x400
+IN_MOVE_SELF = 0x800
+IN_Q_OVERFLOW = 0x4000
+IN_IGNORED = 0x8000
+IN_ONLYDIR = 0x1000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+        IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF |
+        IN_ONLYDIR)
+
+event_s = struct.Struct("iIII")
+
+
+class Inotify:
+    def __init__(self):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.paths = {}
+
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path or '.'), WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise OSError(err, os.strerror(err), path)
+        self.paths[wd] = path
+        return wd
+
+    def read(self):
+        while 1:
+            try:
+                buf = os.read(self.fd, 1 << 16)
+            except BlockingIOError:
+                return
+            pos = 0
+            while pos < len(buf):
+                wd, mask, cookie, length = event_s.unpack_from(buf, pos)
+                pos += event_s.size
+                name = buf[pos:pos+length].rstrip(b'\0').decode(errors='surrogateescape')
+                pos += length
+                yield wd, mask, name
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Monitor:
+    def __init__(self):
+        self.instance = os.urandom(4).hex()
+        self.seq = 0
+        self.min_seq = 0
+        self.journal = []
+        self.inotify = Inotify()
+        self.watch_tree('', report=False)
+
+    def token(self):
+        return f"{self.instance}:{self.seq}"
+
+    def record(self, path):
+        self.seq += 1
+        self.journal.append((self.seq, path))
+        if len(self.journal) > JOURNAL_MAX:
+            drop = len(self.journal) // 2
+            self.min_seq = self.journal[drop - 1][0]
+            del self.journal[:drop]
+
+    def watch_tree(self, top, report=True):
+        stack = [top]
+        while stack:
+            d = stack.pop()
+            if self.inotify.add_watch(d) is None:
+                continue
+            try:
+                it = os.scandir(d or '.')
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            with it:
+                for de in it:
+                    rel = f"{d}/{de.name}" if d else de.name
+                    if rel == '.git':
+                        continue
+                    if report:
+                        self.record(rel)
+                    if de.is_dir(follow_symlinks=False):
+                        stack.append(rel)
+
+    def handle_events(self):
+        for wd, mask, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                self.min_seq = self.seq
+                continue
+            if mask & IN_IGNORED:
+                self.inotify.paths.pop(wd, None)
+                continue
+            d = self.inotify.paths.get(wd)
+            if d is None:
+                continue
+            if not name:
+                if d:
+                    self.record(d)
+                continue
+            rel = f"{d}/{name}" if d else name
+            if rel == '.git' or rel.startswith('.git/'):
+                continue
+            self.record(rel)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                self.watch_tree(rel)
+
+    def changes_since(self, token):
+        instance, _, seq = token.partition(':')
+        if instance != self.instance or not seq.isdigit() or int(seq) < self.min_seq:
+            return None
+        seq = int(seq)
+        changed = set()
+        for s, path in reversed(self.journal):
+            if s <= seq:
+                break
+            changed.add(path)
+        return changed
+
+    def answer(self, conn):
+        data = b''
+        while not data.endswith(b'\n'):
+            chunk = conn.recv(4096)
+            if not chunk:
+                break
+            data += chunk
+        request = data.decode().strip()
+        if request == 'quit':
+            conn.sendall(b'ok\n')
+            return False
+        # Drain pending events so a query sees every change made before it.
+        self.handle_events()
+        changed = self.changes_since(request)
+        reply = self.token().encode() + b'\0'
+        if changed is None:
+            reply += b'/\0'
+        else:
+            reply += b''.join(os.fsencode(p) + b'\0' for p in sorted(changed))
+        conn.sendall(reply)
+        return True
+
+    def serve(self):
+        if os.path.exists(SOCKET_PATH):
+            os.remove(SOCKET_PATH)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(SOCKET_PATH)
+        server.listen(16)
+        sel = selectors.DefaultSelector()
+        sel.register(self.inotify.fd, selectors.EVENT_READ, 'inotify')
+        sel.register(server, selectors.EVENT_READ, 'server')
+        running = True
+        try:
+            while running:
+                for key, _ in sel.select():
+                    if key.data == 'inotify':
+                        self.handle_events()
+                    else:
+                        conn, _ = server.accept()
+                        with conn:
+                            running = self.answer(conn)
+        finally:
+            server.close()
+            self.inotify.close()
+            for path in (SOCKET_PATH, PID_PATH):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+
+def request(msg):
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.connect(SOCKET_PATH)
+    except (FileNotFoundError, ConnectionRefusedError):
+        s.close()
+        return None
+    with s:
+        s.sendall(msg.encode() + b'\n')
+        data = b''
+        while 1:
+            chunk = s.recv(1 << 16)
+            if not chunk:
+                break
+            data += chunk
+    return data
+
+
+def query(token):
+    data = request(token or '-')
+    if not data:
+        return None, None
+    parts = data.split(b'\0')
+    new_token = parts[0].decode()
+    paths = [os.fsdecode(p) for p in parts[1:] if p]
+    if paths == ['/']:
+        return new_token, None
+    return new_token, set(paths)
+
+
+def index_token(index):
+    return index.fsmonitor_token
+
+
+def index_dirty(index):
+    return {os.fsdecode(e.entry_path_name) for e in index.entries if e.fsmonitor_dirty}
+
+
+def set_index_token(index, token, dirty=()):
+    dirty = {os.fsencode(p) for p in dirty}
+    for e in index.entries:
+        e.fsmonitor_dirty = e.entry_path_name in dirty
+    index.fsmonitor_token = token
+
+
+def run():
+    with open(PID_PATH, 'w') as f:
+        f.write(f"{os.getpid()}\n")
+    signal.signal(signal.SIGTERM, lambda *a: sys.exit(0))
+    Monitor().serve()
+
+
+def start():
+    if request('-') is not None:
+        print("fsmonitor is already running")
+        return
+    pid = os.fork()
+    if pid:
+        print(f"fsmonitor started ({pid})")
+        return
+    os.setsid()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(devnull, fd)
+    try:
+        run()
+    finally:
+        os._exit(0)
+
+
+def stop():
+    if request('quit') is None:
+        print("fsmonitor is not running")
+
+
+def status():
+    if request('-') is None:
+        print("fsmonitor is not running")
+    else:
+        print("fsmonitor is watching")
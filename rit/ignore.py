@@ -0,0 +1,125 @@
+import os
+import re
+
+
+def translate(pat):
+    i = 0
+    n = len(pat)
+    res = ''
+    while i < n:
+        c = pat[i]
+        if pat.startswith('**/', i) and (i == 0 or pat[i-1] == '/'):
+            res += '(?:.*/)?'
+            i += 3
+        elif pat.startswith('/**', i) and i + 3 == n:
+            res += '/.*'
+            i += 3
+        elif c == '*':
+            res += '[^/]*'
+            i += 1
+        elif c == '?':
+            res += '[^/]'
+            i += 1
+        elif c == '[':
+            j = i + 1
+            if j < n and pat[j] in '!^':
+                j += 1
+            if j < n and pat[j] == ']':
+                j += 1
+            while j < n and pat[j] != ']':
+                j += 1
+            if j >= n:
+                res += '\\['
+                i += 1
+                continue
+            body = pat[i+1:j]
+            if body[0] in '!^':
+                body = '^' + body[1:]
+            body = body.replace('\\', '\\\\')
+            res += f'(?!/)[{body}]'
+            i = j + 1
+        elif c == '\\' and i + 1 < n:
+            res += re.escape(pat[i+1])
+            i += 2
+        else:
+            res += re.escape(c)
+            i += 1
+    return res
+
+
+def parse_pattern(line, base):
+    if not line or line.startswith('#'):
+        return None
+    if not line.endswith('\\ '):
+        line = line.rstrip(' ')
+    negate = False
+    if line.startswith('!'):
+        negate = True
+        line = line[1:]
+    elif line.startswith('\\!') or line.startswith('\\#'):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    if '/' in line:
+        body = translate(line.lstrip('/'))
+    else:
+        body = '(?:.*/)?' + translate(line)
+    regex = re.escape(base) + body + ('/' if dir_only else '/?')
+    return regex, negate
+
+
+def read_patterns(path, base):
+    try:
+        with open(path, 'rb') as f:
+            lines = f.read().decode(errors='replace').splitlines()
+    except (FileNotFoundError, NotADirectoryError):
+        return []
+    patterns = []
+    for line in lines:
+        p = parse_pattern(line, base)
+        if p is not None:
+            patterns.append(p)
+    return patterns
+
+
+class IgnoreMatcher:
+    def __init__(self, patterns, parent=None):
+        if parent is not None:
+            patterns = parent.patterns + patterns
+        self.patterns = patterns
+        self._regex = None
+        self._negated = None
+
+    def compile(self):
+        # Later patterns take precedence, so they come first in the
+        # alternation and the first alternative to match decides.
+        groups = []
+        self._negated = [False]
+        for regex, negate in reversed(self.patterns):
+            groups.append(f'({regex})')
+            self._negated.append(negate)
+        if groups:
+            self._regex = re.compile('|'.join(groups), re.DOTALL)
+
+    def ignored(self, path, is_dir=False):
+        if self._negated is None:
+            self.compile()
+        if self._regex is None:
+            return False
+        m = self._regex.fullmatch(path + '/' if is_dir else path)
+        if m is None:
+            return False
+        return not self._negated[m.lastindex]
+
+    def child(self, dirname):
+        base = dirname + '/' if dirname else ''
+        patterns = read_patterns(os.path.join(dirname, '.gitignore'), base)
+        if not patterns:
+            return self
+        return IgnoreMatcher(patterns, parent=self)
+
+
+def exclude_matcher():
+    return IgnoreMatcher(read_patterns(os.path.join('.git', 'info', 'exclude'), ''))
@@ -1,49 +1,148 @@
-from collections import OrderedDict
+from rit.lockfile import write_locked
 
 import struct
 import binascii
+import bisect
+import copy
+import mmap
 import os
 import hashlib
-import zlib
 
 
-def unpack_num(p):
-    if len(p) == 4:
-        return struct.unpack(">I", p)[0]
-    elif len(p) == 2:
-        return struct.unpack(">H", p)[0]
-
-
-def pack_num(n, l):
-    if l == 4:
-        return struct.pack(">I", n)
-    elif l == 2:
-        return struct.pack(">H", n)
+entry_s = struct.Struct(">10I20sH")
+extend_s = struct.Struct(">H")
+header_s = struct.Struct(">4sII")
+ext_header_s = struct.Struct(">4sI")
+
+SPLIT_INDEX_MAX_PERCENT = 20
+
+
+def stat_fields(stat):
+    return (
+            (stat.st_ctime_ns // 1000000000) & 0xffffffff,
+            stat.st_ctime_ns % 1000000000,
+            (stat.st_mtime_ns // 1000000000) & 0xffffffff,
+            stat.st_mtime_ns % 1000000000,
+            stat.st_dev & 0xffffffff,
+            stat.st_ino & 0xffffffff,
+            stat.st_uid & 0xffffffff,
+            stat.st_gid & 0xffffffff,
+            stat.st_size & 0xffffffff)
+
+
+def file_mode(stat):
+    if (stat.st_mode & 0o170000) == 0o120000:
+        return 0o120000
+    if stat.st_mode & 0o100:
+        return 0o100755
+    return 0o100644
+
+
+def encode_varint(n):
+    b = bytearray([n & 0x7f])
+    n >>= 7
+    while n:
+        n -= 1
+        b.append(0x80 | (n & 0x7f))
+        n >>= 7
+    return bytes(reversed(b))
+
+
+def decode_varint(data, pos):
+    c = data[pos]
+    pos += 1
+    n = c & 0x7f
+    while c & 0x80:
+        c = data[pos]
+        pos += 1
+        n = ((n + 1) << 7) | (c & 0x7f)
+    return n, pos
+
+
+def common_len(a, b):
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[:mid] == b[:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def ewah_decode(data, start=0):
+    bit_size, nwords = struct.unpack_from(">II", data, start)
+    words = struct.unpack_from(f">{nwords}Q", data, start + 8)
+    bits = []
+    pos = 0
+    i = 0
+    while i < nwords:
+        rlw = words[i]
+        i += 1
+        run = ((rlw >> 1) & 0xffffffff) * 64
+        if rlw & 1:
+            bits.extend(range(pos, pos + run))
+        pos += run
+        for _ in range(rlw >> 33):
+            w = words[i]
+            i += 1
+            while w:
+                low = w & -w
+                bits.append(pos + low.bit_length() - 1)
+                w ^= low
+            pos += 64
+    end = start + 8 + 8*nwords + 4
+    return [b for b in bits if b < bit_size], end
+
+
+def ewah_encode(bit_size, bits):
+    literals = [0] * ((bit_size + 63) // 64)
+    for b in bits:
+        literals[b // 64] |= 1 << (b % 64)
+    words = [len(literals) << 33] + literals
+    return (struct.pack(">II", bit_size, len(words)) +
+            struct.pack(f">{len(words)}Q", *words) + struct.pack(">I", 0))
 
 
 class Parser:
-    def __init__(self, data):
+    def __init__(self, data, pos=0):
         self.data = data
-        self.mylen = 0
+        self.pos = pos
 
     def parse(self, length):
-        ret,self.data = self.data[:length], self.data[length:]
-        self.mylen += length
+        ret = self.data[self.pos:self.pos+length]
+        self.pos += length
         return ret
 
     def rest(self):
-        return self.data
+        return self.data[self.pos:]
 
     def parse_to(self, char):
-        spl = self.data.split(char, maxsplit=1)
-        if len(spl) != 2:
+        end = self.data.find(char, self.pos)
+        if end < 0:
             raise ValueError(f"Char not found: {char}")
-        ret,self.data = spl
-        self.mylen += len(ret) + 1
+        ret = self.data[self.pos:end]
+        self.pos = end + 1
         return ret
 
 
+def read_fsmonitor_ext(data):
+    if data[:4] != struct.pack(">I", 2):
+        return None, []
+    end = data.index(b'\0', 4)
+    token = data[4:end].decode()
+    return token, ewah_decode(data, end + 5)[0]
+
+
+def fsmonitor_ext(token, num, dirty):
+    bitmap = ewah_encode(num, dirty)
+    data = struct.pack(">I", 2) + token.encode() + b'\0'
+    return data + struct.pack(">I", len(bitmap)) + bitmap
+
+
 class IndexEntry:
+    fsmonitor_dirty = False
+
     def __init__(self,
             c_sec, c_nano, m_sec, m_nano,
             dev, ino, mode,
@@ -68,61 +167,104 @@ class IndexEntry:
         self.obj = (mode >> 12) & 0xf
         self.perms = mode & 0o777
 
-    def encode(self):
-        b = b""
-        b += pack_num(self.c_sec, 4)
-        b += pack_num(self.c_nano, 4)
-        b += pack_num(self.m_sec, 4)
-        b += pack_num(self.m_nano, 4)
-        b += pack_num(self.dev, 4)
-        b += pack_num(self.ino, 4)
-        b += pack_num(self.mode, 4)
-        b += pack_num(self.uid, 4)
-        b += pack_num(self.gid, 4)
-        b += pack_num(self.size, 4)
-        b += self.sha1
-        b += pack_num(self.flags, 2)
-        extended = (self.flags >> 14) & 1
-        if extended:
-            b += pack_num(self.v3_extend, 2)
-        b += self.entry_path_name
-        pad_len = 8 - (len(b) % 8)
-        b += b"\x00"*pad_len
-        return b
+    def fields(self):
+        return (self.stat_key(), self.mode, self.sha1,
+                self.flags & ~0xfff, self.v3_extend)
+
+    def stat_key(self):
+        return (
+                self.c_sec, self.c_nano, self.m_sec, self.m_nano,
+                self.dev, self.ino, self.uid, self.gid, self.size)
+
+    def set_stat(self, stat):
+        (self.c_sec, self.c_nano, self.m_sec, self.m_nano,
+                self.dev, self.ino, self.uid, self.gid,
+                self.size) = stat_fields(stat)
+
+    def stat_matches(self, stat):
+        if self.mode != file_mode(stat):
+            return False
+        cur = stat_fields(stat)
+        # st_dev is not stable across some filesystems, so like git
+        # it is left out of the comparison.
+        return self.stat_key()[:4] + self.stat_key()[5:] == cur[:4] + cur[5:]
+
+    def racily_clean(self, index_mtime):
+        sec, nano = index_mtime
+        return (self.m_sec, self.m_nano) >= (sec, nano)
+
+    def header_size(self):
+        if (self.flags >> 14) & 1:
+            return entry_s.size + extend_s.size
+        return entry_s.size
+
+    def encoded_size(self, prev=None):
+        name_len = len(self.entry_path_name)
+        if prev is None:
+            return (self.header_size() + name_len + 8) & ~7
+        common = common_len(prev, self.entry_path_name)
+        strip = len(prev) - common
+        return self.header_size() + len(encode_varint(strip)) + name_len - common + 1
+
+    def pack_into(self, buf, pos, prev=None):
+        name = self.entry_path_name
+        flags = (self.flags & ~0xfff) | min(len(name), 0xfff)
+        entry_s.pack_into(buf, pos,
+                self.c_sec, self.c_nano, self.m_sec, self.m_nano,
+                self.dev, self.ino, self.mode,
+                self.uid, self.gid, self.size, self.sha1, flags)
+        end = pos + entry_s.size
+        if (flags >> 14) & 1:
+            extend_s.pack_into(buf, end, self.v3_extend)
+            end += extend_s.size
+        if prev is None:
+            buf[end:end+len(name)] = name
+            # Padding is already zero in a freshly allocated buffer.
+            return pos + (((end - pos) + len(name) + 8) & ~7)
+        common = common_len(prev, name)
+        strip = encode_varint(len(prev) - common)
+        buf[end:end+len(strip)] = strip
+        end += len(strip)
+        suffix = name[common:]
+        buf[end:end+len(suffix)] = suffix
+        return end + len(suffix) + 1
+
+    def encode(self, prev=None):
+        buf = bytearray(self.encoded_size(prev))
+        self.pack_into(buf, 0, prev)
+        return bytes(buf)
 
 
 class IndexEntryParser(Parser):
-    def read(self):
-        c_sec = unpack_num(self.parse(4))
-        c_nano = unpack_num(self.parse(4))
-        m_sec = unpack_num(self.parse(4))
-        m_nano = unpack_num(self.parse(4))
-        dev = unpack_num(self.parse(4))
-        ino = unpack_num(self.parse(4))
-        mode = unpack_num(self.parse(4))
-
-        #obj = (mode >> 12) & 0xf
-        #perm = mode & 0o777
-
-        uid = unpack_num(self.parse(4))
-        gid = unpack_num(self.parse(4))
-        size = unpack_num(self.parse(4))
-        sha1 = self.parse(20)
-        flags = unpack_num(self.parse(2))
-
-        assume_valid = (flags >> 15) & 1
+    def read(self, prev=None):
+        (c_sec, c_nano, m_sec, m_nano,
+                dev, ino, mode,
+                uid, gid, size, sha1, flags) = entry_s.unpack_from(self.data, self.pos)
+        start = self.pos
+        self.pos += entry_s.size
+
         extended = (flags >> 14) & 1
-        stage = (flags >> 12) & 0b11
         name_len = flags & 0xfff
 
-        if extended:   
-            v3_extend = unpack_num(self.parse(2))
+        if extended:
+            v3_extend, = extend_s.unpack_from(self.data, self.pos)
+            self.pos += extend_s.size
         else:
             v3_extend = 0
 
-        entry_path_name = self.parse(name_len)
-        pad_len = 8 - (self.mylen % 8)
-        pad = self.parse(pad_len)
+        if prev is None:
+            header_len = self.pos - start
+            if name_len < 0xfff:
+                entry_path_name = self.parse(name_len)
+            else:
+                entry_path_name = self.parse_to(b"\x00")
+            self.pos = start + ((header_len + len(entry_path_name) + 8) & ~7)
+        else:
+            # Index v4: drop N bytes from the previous path, then append a
+            # NUL-terminated suffix.
+            strip, self.pos = decode_varint(self.data, self.pos)
+            suffix = self.parse_to(b"\x00")
+            entry_path_name = prev[:len(prev) - strip] + suffix
         return IndexEntry(
                 c_sec, c_nano, m_sec, m_nano,
                 dev, ino, mode,
@@ -140,33 +282,28 @@ class ExtensionEntry:
         return len(self.encoded_data())
 
     def encoded_data(self):
-        encoded = b''
         if self.sig == b'TREE':
-            for tree in self.data:
-                encoded += tree.encode()
-        return encoded
+            return b''.join(tree.encode() for tree in self.data)
+        return self.data
 
     def encode(self):
-        b = b''
-        b += self.sig
-        b += pack_num(self.size, 4)
-        b += self.encoded_data()
-        return b
+        data = self.encoded_data()
+        return ext_header_s.pack(self.sig, len(data)) + data
 
 
 class ExtensionEntryParser(Parser):
     def read(self):
-        sig = self.parse(4)
-        size = unpack_num(self.parse(4))
-        extdata,self.data = self.data[:size], self.data[size:]
+        sig, size = ext_header_s.unpack_from(self.data, self.pos)
+        self.pos += ext_header_s.size
+        end = self.pos + size
         if sig == b'TREE':
             trees = []
-            while extdata:
-                tp = TreeEntryParser(extdata)
-                t = tp.read()
-                trees.append(t)
-                extdata = tp.rest()
+            tp = TreeEntryParser(self.data, self.pos)
+            while tp.pos < end:
+                trees.append(tp.read())
+            self.pos = end
             return ExtensionEntry(sig, trees)
+        return ExtensionEntry(sig, self.parse(size))
 
 
 class TreeEntry:
@@ -203,14 +340,46 @@ class Index:
         self.sig = sig
         self.ver = ver
         #self._num = num
+        names = [e.entry_path_name for e in entries]
+        if any(a > b for a, b in zip(names, names[1:])):
+            entries = sorted(entries, key=lambda x: x.entry_path_name)
+            names = [e.entry_path_name for e in entries]
         self.entries = entries
+        self.names = names
+        self.paths = {e.entry_path_name: e for e in entries}
         self.exts = exts
+        self._tree_nodes = None
+        self.fsmonitor_token = None
+        ext = self.get_ext(b'FSMN')
+        if ext is not None:
+            # The dirty bitmap is positional, so it is tied to the entries
+            # here and rebuilt from them on write.
+            self.exts.remove(ext)
+            self.fsmonitor_token, dirty = read_fsmonitor_ext(ext.data)
+            for i in dirty:
+                if i < len(entries):
+                    entries[i].fsmonitor_dirty = True
 
     @property
     def num(self):
         return len(self.entries)
 
+    def extensions(self):
+        if self.fsmonitor_token is None:
+            return self.exts
+        dirty = [i for i, e in enumerate(self.entries) if e.fsmonitor_dirty]
+        data = fsmonitor_ext(self.fsmonitor_token, len(self.entries), dirty)
+        return self.exts + [ExtensionEntry(b'FSMN', data)]
+
+    def get_ext(self, sig):
+        for e in self.exts:
+            if e.sig == sig:
+                return e
+        return None
+
     def set_ext(self, ext):
+        if ext.sig == b'TREE':
+            self._tree_nodes = None
         for idx,e in enumerate(self.exts):
             if e.sig == ext.sig:
                 self.exts[idx] = ext
@@ -218,18 +387,135 @@ class Index:
         else:
             self.exts.append(ext)
 
-    def add_entry(self, mode, hsh, filename):
-        stat = os.stat(filename)
-        c_sec = int(stat.st_ctime)
-        c_nano = int(1000000000*(stat.st_ctime%1))
-        m_sec = int(stat.st_mtime)
-        m_nano = int(1000000000*(stat.st_mtime%1))
-        dev = stat.st_dev
-        ino = stat.st_ino
-        mode = mode
-        uid = stat.st_uid
-        gid = stat.st_gid
-        size = stat.st_size
+    def get(self, path):
+        return self.paths.get(path)
+
+    def position(self, path):
+        i = bisect.bisect_left(self.names, path)
+        if i < len(self.names) and self.names[i] == path:
+            return i
+        return -1
+
+    def tree_nodes(self):
+        if self._tree_nodes is None:
+            nodes = {}
+            children = {}
+            ext = self.get_ext(b'TREE')
+            if ext is not None:
+                # Entries are stored depth first; subtree_count says how
+                # many children follow each one.
+                stack = []
+                for tree in ext.data:
+                    while stack and stack[-1][1] == 0:
+                        stack.pop()
+                    if stack:
+                        parent = stack[-1]
+                        parent[1] -= 1
+                        path = os.path.join(parent[0], tree.path)
+                        children[parent[0]].append(path)
+                    else:
+                        path = tree.path
+                    nodes[path] = tree
+                    children[path] = []
+                    stack.append([path, tree.subtree_count])
+            self._tree_nodes = nodes
+            self._tree_children = children
+        return self._tree_nodes
+
+    def cache_tree(self, writer):
+        nodes = self.tree_nodes()
+        children = self._tree_children
+        names = self.names
+        entries = self.entries
+        trees = []
+        built = []
+
+        def reuse(path):
+            trees.append(nodes[path])
+            for child in children[path]:
+                reuse(child)
+
+        def build(prefix, name, start, end):
+            tree = nodes.get(prefix)
+            if tree is not None and tree.entry_count == end - start:
+                reuse(prefix)
+                return tree.hash
+            node = TreeEntry(name, end - start, 0, b'')
+            trees.append(node)
+            items = []
+            skip = len(prefix) + 1 if prefix else 0
+            i = start
+            while i < end:
+                rest = names[i][skip:]
+                slash = rest.find(b'/')
+                if slash < 0:
+                    e = entries[i]
+                    items.append((rest, f'{e.mode:o}'.encode(), e.sha1))
+                    i += 1
+                    continue
+                sub = names[i][:skip+slash]
+                # Every path under sub/ sorts before sub0, since '0'
+                # follows '/'.
+                sub_end = bisect.bisect_left(names, sub + b'0', i, end)
+                h = build(sub, rest[:slash], i, sub_end)
+                items.append((rest[:slash+1], b'40000', h))
+                node.subtree_count += 1
+                i = sub_end
+            # Trees order directories as if their names ended in '/'.
+            items.sort()
+            data = b''.join(mode + b' ' + n.rstrip(b'/') + b'\x00' + h for n, mode, h in items)
+            obj = f"tree {len(data)}\x00".encode() + data
+            node.hash = hashlib.sha1(obj).digest()
+            writer.write(node.hash, obj, raw=True)
+            built.append(node)
+            return node.hash
+
+        h = build(b'', b'', 0, len(entries))
+        if built:
+            self.set_ext(ExtensionEntry(b'TREE', trees))
+        return h, bool(built)
+
+    def invalidate_path(self, path):
+        nodes = self.tree_nodes()
+        dirname = os.path.dirname(path)
+        while True:
+            tree = nodes.get(dirname)
+            if tree is not None:
+                tree.entry_count = -1
+                tree.hash = b''
+            if not dirname:
+                break
+            dirname = os.path.dirname(dirname)
+
+    def put_entry(self, entry):
+        path = entry.entry_path_name
+        existing = self.paths.get(path)
+        self.paths[path] = entry
+        if existing is not None:
+            self.entries[self.position(path)] = entry
+            if existing.sha1 == entry.sha1 and existing.mode == entry.mode:
+                return False
+        else:
+            i = bisect.bisect_left(self.names, path)
+            self.names.insert(i, path)
+            self.entries.insert(i, entry)
+        self.invalidate_path(path)
+        return True
+
+    def remove_entry(self, path):
+        if self.paths.pop(path, None) is None:
+            return False
+        i = self.position(path)
+        del self.names[i]
+        del self.entries[i]
+        self.invalidate_path(path)
+        return True
+
+    def add_entry(self, mode, hsh, filename, stat=None):
+        if stat is None:
+            stat = os.lstat(filename)
+        (c_sec, c_nano, m_sec, m_nano,
+                dev, ino, uid, gid, size) = stat_fields(stat)
         sha1 = hsh
         flags = len(filename) & 0xfff
         v3_extend = 0
@@ -238,77 +524,166 @@ class Index:
                 c_sec, c_nano, m_sec, m_nano,
                 dev, ino, mode,
                 uid, gid, size, sha1, flags, v3_extend, entry_path_name)
-        changed = False
-        for i,existing_entry in enumerate(self.entries):
-            if existing_entry.entry_path_name == entry_path_name:
-                if existing_entry.sha1 == sha1:
-                    break
-                self.entries[i] = entry
-                changed = True
-                break
-        else: 
-            self.entries.append(entry)
-            changed = True
-        if changed:
-            self
-
-        containing = set(trees_containing(entry_path_name))
-        for ext in self.exts:
-            if ext.sig == b'TREE':
-                for tree in ext.data:
-                    if tree.hash in containing:
-                        tree.entry_count = -1
-                        tree.hash = b''
-
+        return self.put_entry(entry)
 
     def encode(self):
-        b = b''
-        b += self.sig
-        b += pack_num(self.ver, 4)
-        b += pack_num(self.num, 4)
-        sorted_entries = sorted(self.entries, key=lambda x: x.entry_path_name)
-        for e in sorted_entries:
-            b += e.encode()
-        for e in self.exts:
-            b += e.encode()
-        h = hashlib.sha1(b).digest()
-        b += h
-        return b
+        return encode_index(self.sig, self.ver, self.entries, self.extensions())
+
+
+def encode_index(sig, ver, entries, exts):
+    if ver == 2 and any((e.flags >> 14) & 1 for e in entries):
+        ver = 3
+    v4 = ver == 4
+    exts = [e.encode() for e in exts]
+
+    size = header_s.size
+    prev = b'' if v4 else None
+    for e in entries:
+        size += e.encoded_size(prev)
+        if v4:
+            prev = e.entry_path_name
+    size += sum(len(e) for e in exts) + 20
+
+    buf = bytearray(size)
+    header_s.pack_into(buf, 0, sig, ver, len(entries))
+    pos = header_s.size
+    prev = b'' if v4 else None
+    for e in entries:
+        pos = e.pack_into(buf, pos, prev)
+        if v4:
+            prev = e.entry_path_name
+    for e in exts:
+        buf[pos:pos+len(e)] = e
+        pos += len(e)
+    buf[pos:] = hashlib.sha1(memoryview(buf)[:pos]).digest()
+    return buf
 
 
 class IndexParser(Parser):
     def read(self):
-        header = self.parse(12)
-        sig = header[:4]
-        ver = unpack_num(header[4:8])
-        num = unpack_num(header[8:])
+        return Index(*self.read_raw())
+
+    def read_raw(self):
+        end = len(self.data) - 20
+        if hashlib.sha1(memoryview(self.data)[:end]).digest() != self.data[end:]:
+            raise ValueError("Index checksum mismatch")
+        sig, ver, num = header_s.unpack_from(self.data, self.pos)
+        self.pos += header_s.size
+        if sig != b'DIRC' or ver not in (2, 3, 4):
+            raise ValueError(f"Unsupported index version: {ver}")
         entries = []
         exts = []
+        ip = IndexEntryParser(self.data, self.pos)
+        prev = b'' if ver == 4 else None
         for _ in range(num):
-            ip = IndexEntryParser(self.data)
-            i = ip.read()
-            entries.append(i)
-            self.data = ip.rest()
+            e = ip.read(prev)
+            entries.append(e)
+            if ver == 4:
+                prev = e.entry_path_name
+        self.pos = ip.pos
+
+        while self.pos < end:
+            ep = ExtensionEntryParser(self.data, self.pos)
+            exts.append(ep.read())
+            self.pos = ep.pos
+        return sig, ver, entries, exts
+
+
+def shared_index_path(sha):
+    return os.path.join('.git', f'sharedindex.{binascii.hexlify(sha).decode()}')
+
 
-        while len(self.data) > 20:
-            ep = ExtensionEntryParser(self.data)
-            e = ep.read()
-            exts.append(e)
-            self.data = ep.rest()
-        hsh = self.data
-        return Index(sig, ver, entries, exts)
+def read_index_file(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    with data:
+        return IndexParser(data).read_raw()
 
 
 class IndexWrapper:
     def __init__(self):
         self.fname = './.git/index'
+        self.split = False
+        self.shared_sha = None
+        self.base_names = None
+        self.base_fields = None
         if not os.path.isfile(self.fname):
             self.index = Index(b'DIRC', 2, [], [])
         else:
-            with open(self.fname, 'rb') as f:
-                data = f.read()
-            ip = IndexParser(data)
-            self.index = ip.read()
+            sig, ver, entries, exts = read_index_file(self.fname)
+            for ext in exts:
+                if ext.sig == b'link':
+                    exts.remove(ext)
+                    entries = self.merge_shared(ext.data, entries)
+                    self.split = True
+                    break
+            self.index = Index(sig, ver, entries, exts)
+
+    def merge_shared(self, link, entries):
+        sha = link[:20]
+        if sha == b'\0' * 20:
+            return entries
+        _, _, base, _ = read_index_file(shared_index_path(sha))
+        self.shared_sha = sha
+        self.base_names = [e.entry_path_name for e in base]
+        self.base_fields = [e.fields() for e in base]
+        if len(link) == 20:
+            return base + entries
+        deleted, pos = ewah_decode(link, 20)
+        replaced, pos = ewah_decode(link, pos)
+        merged = list(base)
+        for k, i in enumerate(replaced):
+            e = entries[k]
+            e.entry_path_name = base[i].entry_path_name
+            merged[i] = e
+        for i in deleted:
+            merged[i] = None
+        return [e for e in merged if e is not None] + entries[len(replaced):]
+
+    def write_shared(self):
+        index = self.index
+        data = encode_index(index.sig, index.ver, index.entries, [])
+        sha = bytes(data[-20:])
+        write_locked(shared_index_path(sha), data)
+        self.shared_sha = sha
+        self.base_names = list(index.names)
+        self.base_fields = [e.fields() for e in index.entries]
+
+    def encode_split(self):
+        index = self.index
+        if self.base_names is not None:
+            base_pos = {name: i for i, name in enumerate(self.base_names)}
+            replaced = []
+            added = []
+            for e in index.entries:
+                i = base_pos.pop(e.entry_path_name, None)
+                if i is None:
+                    added.append(e)
+                    continue
+                if e.fields() != self.base_fields[i]:
+                    replaced.append((i, e))
+            deleted = sorted(base_pos.values())
+            nbase = len(self.base_names)
+            changes = len(replaced) + len(added) + len(deleted)
+            if changes * 100 <= SPLIT_INDEX_MAX_PERCENT * nbase:
+                entries = []
+                for i, e in replaced:
+                    # Replaced entries are matched to the shared index by
+                    # position, so their names are left out.
+                    e = copy.copy(e)
+                    e.entry_path_name = b''
+                    entries.append(e)
+                entries += added
+                link = self.shared_sha
+                link += ewah_encode(nbase, deleted)
+                link += ewah_encode(nbase, [i for i, _ in replaced])
+                exts = [ExtensionEntry(b'link', link)] + index.extensions()
+                return encode_index(index.sig, index.ver, entries, exts)
+        self.write_shared()
+        nbase = len(self.base_names)
+        link = self.shared_sha + ewah_encode(nbase, []) + ewah_encode(nbase, [])
+        exts = [ExtensionEntry(b'link', link)] + index.extensions()
+        return encode_index(index.sig, index.ver, [], exts)
 
     def entries(self):
         return [(e.entry_path_name, binascii.hexlify(e.sha1).decode()) for e in self.index.entries]
@@ -327,9 +702,32 @@ class IndexWrapper:
                             t.subtree_count,
                             binascii.hexlify(t.hash))
 
-    def write(self):
-        with open(self.fname, 'wb') as f:
-            f.write(self.index.encode())
+    def mtime(self):
+        try:
+            ns = os.stat(self.fname).st_mtime_ns
+        except FileNotFoundError:
+            return (0, 0)
+        return ((ns // 1000000000) & 0xffffffff, ns % 1000000000)
+
+    def write(self, split=None):
+        if split is not None:
+            self.split = split
+        old = self.shared_sha
+        if self.split:
+            data = self.encode_split()
+        else:
+            data = self.index.encode()
+            self.shared_sha = None
+            self.base_names = None
+            self.base_fields = None
+        write_locked(self.fname, data)
+        # The old shared index stays until the index that links to it has
+        # been replaced, so a failed write never leaves a dangling link.
+        if old is not None and old != self.shared_sha:
+            try:
+                os.remove(shared_index_path(old))
+            except FileNotFoundError:
+                pass
 
     def add_entry(self, mode, hsh, filename):
         return self.index.add_entry(mode, hsh, filename)
@@ -338,96 +736,6 @@ class IndexWrapper:
         return self.index.encode()
 
 
-def trees_containing(path):
-    hashes = []
-    i = IndexWrapper().index
-    root = Tree(key=lambda x: os.path.commonpath([path, x.root]) == x.root)
-    for e in i.entries:
-        root.add(e)
-    for name, t in root.iter():
-        if t.marked():
-            h,_ = t.hash()
-            hashes.append(h)
-    return hashes
-
-
-class Tree(dict):
-    def __init__(self, root=b'', key=lambda x: None):
-        self['files'] = []
-        self['dirs'] = OrderedDict()
-        self.root = root
-        self.entry_count = 0
-        self.key = key
-
-    def marked(self):
-        return self.key(self)
-
-    def add(self, indexentry):
-        path = indexentry.entry_path_name
-        dirname,fname = os.path.split(path)
-        if os.path.commonpath([dirname, self.root]) == self.root:
-            dirname = dirname[len(self.root):].lstrip(b'/')
-        if len(dirname) == 0:
-            parts = []
-        else:
-            parts = dirname.split(b'/')
-        cur = self
-        for part in parts:
-            cur.entry_count += 1
-            if part not in cur['dirs']:
-                new = Tree(key=self.key)
-                new.root = os.path.join(cur.root, part)
-                cur['dirs'][part] = new
-            cur = cur['dirs'][part]
-        cur['files'].append((fname, indexentry))
-        cur.entry_count += 1
-
-    def iter(self):
-        stack = [(b'', self)]
-        while stack:
-            name, cur = stack[0]
-            del stack[0]
-            stack = [(t, cur['dirs'][t]) for t in cur['dirs']] + stack
-            yield name, cur
-
-    def hash(self):
-        items = []
-        for fname,entry in self['files']:
-            items.append((fname, entry, 0))
-        for dname in self['dirs']:
-            items.append((dname, self['dirs'][dname], 1))
-        sorted_items = sorted(items)
-        data = b''
-        for name, obj, flag in sorted_items:
-            # 0 is file, 1 is tree
-            if flag == 0:
-                e = obj
-                mode = e.obj << 12 | e.perms
-                mode_s = f'{mode:06o}'.encode()
-                entry_data = b''
-                entry_data += mode_s + b' '
-                entry_data += name + b'\x00'
-                entry_data += e.sha1
-                data += entry_data
-            elif flag == 1:
-                t = obj
-                mode = b'40000'
-                entry_data = b''
-                entry_data += mode + b' '
-                entry_data += name + b'\x00'
-                hsh,_ = t.hash()
-                entry_data += hsh
-                data += entry_data
-
-        length = len(data)
-        tree = f"tree {length}".encode()
-        tree += b"\x00"
-        tree += data
-        zipped = zlib.compress(tree)
-        h = hashlib.sha1(tree).digest()
-        return h, zipped
-
-
 if __name__ == '__main__':
     i = IndexWrapper()
     i.show()
@@ -0,0 +1,25 @@
+import os
+import sys
+
+
+def create_lock(path):
+    lock = path + '.lock'
+    try:
+        fd = os.open(lock, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    except FileExistsError:
+        sys.exit(f"fatal: Unable to create '{os.path.normpath(lock)}': File exists.")
+    return fd, lock
+
+
+def write_locked(path, data):
+    fd, lock = create_lock(path)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(lock, path)
+    except BaseException:
+        try:
+            os.unlink(lock)
+        except FileNotFoundError:
+            pass
+        raise
@@ -0,0 +1,122 @@
+import binascii
+import os
+import zlib
+import rit
+
+
+def object_path(objdir, sha):
+    h = binascii.hexlify(sha).decode()
+    return os.path.join(objdir, h[:2], h[2:])
+
+
+def loose_objects(objdir, prefixes):
+    present = set()
+    for prefix in prefixes:
+        dirname = os.path.join(objdir, prefix)
+        if not os.path.isdir(dirname):
+            os.mkdir(dirname)
+            continue
+        for fname in os.listdir(dirname):
+            present.add(prefix + fname)
+    return present
+
+
+def temp_file(dirname, data, fsync=False):
+    while 1:
+        tmp = os.path.join(dirname, f"tmp_obj_{os.urandom(6).hex()}")
+        try:
+            fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o444)
+        except FileExistsError:
+            continue
+        break
+    with os.fdopen(fd, 'wb') as f:
+        f.write(data)
+        if fsync:
+            f.flush()
+            os.fsync(f.fileno())
+    return tmp
+
+
+def fsync_dir(dirname):
+    fd = os.open(dirname, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def install(tmp, path):
+    try:
+        os.link(tmp, path)
+    except FileExistsError:
+        pass
+    except OSError:
+        os.rename(tmp, path)
+        return
+    os.unlink(tmp)
+
+
+def write_file(path, data):
+    install(temp_file(os.path.dirname(path), data), path)
+
+
+class ObjectWriter:
+    def __init__(self, objdir=os.path.join('.git', 'objects'), fsync=False):
+        self.objdir = objdir
+        self.fsync = fsync
+        self.dirs = set()
+        self.scanned = False
+        self.queue = {}
+        self.written = 0
+        self.skipped = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, typ, value, tb):
+        if typ is None:
+            self.flush()
+
+    def exists(self, sha):
+        if sha in self.queue:
+            return True
+        if os.path.isfile(object_path(self.objdir, sha)):
+            return True
+        # Pick up new packs once per writer rather than rescanning the pack
+        # directory for every object that is not packed.
+        if not self.scanned:
+            rit.pack.load_packs(os.path.join(self.objdir, 'pack'))
+            self.scanned = True
+        return rit.pack.find_packed(sha, rescan=False) is not None
+
+    def write(self, sha, data, raw=False):
+        if self.exists(sha):
+            self.skipped += 1
+            return False
+        if raw:
+            data = zlib.compress(data)
+        self.queue[sha] = data
+        return True
+
+    def flush(self):
+        temps = []
+        dirs = set()
+        for sha, data in self.queue.items():
+            path = object_path(self.objdir, sha)
+            dirname = os.path.dirname(path)
+            if dirname not in self.dirs:
+                os.makedirs(dirname, exist_ok=True)
+                self.dirs.add(dirname)
+            dirs.add(dirname)
+            temps.append((temp_file(dirname, data, self.fsync), path))
+        if self.fsync and temps:
+            for dirname in dirs:
+                fsync_dir(dirname)
+            fsync_dir(self.objdir)
+        for tmp, path in temps:
+            install(tmp, path)
+        if self.fsync and temps:
+            for dirname in dirs:
+                fsync_dir(dirname)
+        self.written += len(temps)
+        self.queue.clear()
@@ -1,9 +1,14 @@
+from rit.pack import read_packed
+from rit.cache import LRUCache
+
 import zlib
 import binascii
 import os
 
 
 class GitObject:
+    __slots__ = ('type', 'data', 'hash')
+
     def __init__(self, typ, data, hsh):
         self.type = typ
         self.data = data
@@ -11,39 +16,46 @@ class GitObject:
 
 
 class GitTree(GitObject):
+    __slots__ = ('dirname',)
+
     def __init__(self, typ, data, hsh, dirname=b''):
         super().__init__(typ, data, hsh)
-        entries = []
-        while data:
-            perms,data = data.split(b' ', maxsplit=1)
-            name,data = data.split(b'\x00', maxsplit=1)
-            hsh,data = data[:20], data[20:]
-            entry = (perms, name, binascii.hexlify(hsh).decode())
-            entries.append(entry)
-        self.entries = entries
         self.dirname = dirname
 
+    def __iter__(self):
+        data = self.data
+        view = memoryview(data)
+        pos = 0
+        end = len(data)
+        while pos < end:
+            sp = data.index(b' ', pos)
+            nul = data.index(b'\x00', sp)
+            yield data[pos:sp], data[sp+1:nul], bytes(view[nul+1:nul+21])
+            pos = nul + 21
+
+    @property
+    def entries(self):
+        return [(perms, name, binascii.hexlify(sha).decode()) for perms, name, sha in self]
+
     def encode(self):
         result = []
-        for perms, name, hsh in self.entries:
+        for perms, name, sha in self:
             if perms.startswith(b'1'):
                 typ = 'blob'
             else:
                 typ = 'tree'
             p = int(perms, 8)
             n = name.decode()
+            hsh = binascii.hexlify(sha).decode()
             result.append(f"{p:06o} {typ} {hsh}    {n}\n")
         return ''.join(result).encode()
 
     def walk(self):
         result = []
-        for perms, name, hsh in self.entries:
-            if perms.startswith(b'1'):
-                typ = 'blob'
-            else:
-                typ = 'tree'
+        for perms, name, sha in self:
             full = os.path.join(self.dirname, name)
-            if typ == 'tree':
+            hsh = binascii.hexlify(sha).decode()
+            if not perms.startswith(b'1'):
                 op = ObjectParser(hsh, dirname=full)
                 t = op.parse()
                 result += t.walk()
@@ -53,58 +65,145 @@ class GitTree(GitObject):
 
 
 class GitBlob(GitObject):
+    __slots__ = ()
+
     def encode(self):
         return self.data
 
 
 class GitCommit(GitObject):
+    __slots__ = ('_tree', '_parents', '_headers', '_message')
+
     def __init__(self, typ, data, hsh):
         super().__init__(typ, data, hsh)
-
-        line,data = data.split(b'\n', maxsplit=1)
-        assert line.startswith(b'tree')
-        tree = line.split(maxsplit=1)[1]
-
-        parents = []
-        while 1:
-            line,data = data.split(b'\n', maxsplit=1)
-            parent = b''
-            if line.startswith(b'parent'):
-                parent = line.split(maxsplit=1)[1]
-                parents.append(parent.decode())
-            else:
-                break
-            #elif line.startswith(b'author'):
-            #    author = line.split(maxsplit=1)[1]
-            #    break
-            #else:
-            #    assert False
-            #if parent:
-            #    line,data = data.split(b'\n', maxsplit=1)
-            #    assert line.startswith(b'author')
-        assert line.startswith(b'author')
-        author = line.split(maxsplit=1)[1]
-        line,data = data.split(b'\n', maxsplit=1)
-        assert line.startswith(b'committer')
-        committer = line.split(maxsplit=1)[1]
-        #assert data.startswith(b'\n')
-        message = data.strip()
-        #data = data[1:]
-        #line = data.strip()
-        #line,data = data.split(b'\n', maxsplit=1)
-        #print(line)
-        #message = line.split(maxsplit=1)[1]
-
-        self.tree = tree
-        self.parents = parents
-        self.author = author
-        self.committer = committer
-        self.message = message
+        self._tree = None
+        self._parents = None
+        self._headers = None
+        self._message = None
+
+    @property
+    def tree(self):
+        if self._tree is None:
+            end = self.data.index(b'\n')
+            assert self.data.startswith(b'tree ')
+            self._tree = self.data[5:end]
+        return self._tree
+
+    @property
+    def parents(self):
+        if self._parents is None:
+            data = self.data
+            parents = []
+            pos = data.index(b'\n') + 1
+            while data.startswith(b'parent ', pos):
+                end = data.index(b'\n', pos)
+                parents.append(data[pos+7:end].decode())
+                pos = end + 1
+            self._parents = parents
+        return self._parents
+
+    def parse_headers(self):
+        head,_,message = self.data.partition(b'\n\n')
+        headers = {}
+        for line in head.split(b'\n'):
+            key,_,value = line.partition(b' ')
+            headers.setdefault(key, value)
+        assert b'author' in headers
+        assert b'committer' in headers
+        self._headers = headers
+        self._message = message.strip()
+
+    @property
+    def author(self):
+        if self._headers is None:
+            self.parse_headers()
+        return self._headers[b'author']
+
+    @property
+    def committer(self):
+        if self._headers is None:
+            self.parse_headers()
+        return self._headers[b'committer']
+
+    @property
+    def message(self):
+        if self._headers is None:
+            self.parse_headers()
+        return self._message
+
+    @property
+    def date(self):
+        return int(self.committer.rsplit(maxsplit=2)[1])
 
     def encode(self):
         return self.data
 
 
+META_CACHE_SIZE = 64 * 1024 * 1024
+
+BLOB_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class ObjectCache:
+    def __init__(self, meta_size=META_CACHE_SIZE, blob_size=BLOB_CACHE_SIZE):
+        self.meta = LRUCache(meta_size)
+        self.blobs = LRUCache(blob_size)
+        self.misses = 0
+
+    def get(self, hsh):
+        for cache in (self.meta, self.blobs):
+            if hsh in cache:
+                return cache.get(hsh)
+        self.misses += 1
+        return None
+
+    def put(self, hsh, typ, data):
+        cache = self.blobs if typ == b'blob' else self.meta
+        cache.put(hsh, (typ, data), len(data))
+
+    @property
+    def hits(self):
+        return self.meta.hits + self.blobs.hits
+
+    def ratio(self):
+        total = self.hits + self.misses
+        if not total:
+            return 0.0
+        return self.hits / total
+
+    def stats(self):
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'ratio': self.ratio(),
+                'meta_bytes': self.meta.size,
+                'blob_bytes': self.blobs.size,
+                }
+
+
+object_cache = ObjectCache()
+
+
+def read_raw(hsh):
+    fname = f".git/objects/{hsh[:2]}/{hsh[2:]}"
+    try:
+        with open(fname, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        packed = read_packed(hsh)
+        if packed is None:
+            raise
+        return packed
+    text = zlib.decompress(data)
+    spl = text.split(b' ', maxsplit=1)
+    assert len(spl) == 2
+    h,text = spl
+    n,rest = text.split(b'\x00', 1)
+    n = int(n)
+    assert len(rest) == n
+    return h, rest
+
+
 class ObjectParser:
     def __init__(self, hsh, dirname=b''):
         self.dirname = dirname
@@ -113,19 +212,14 @@ class ObjectParser:
             hsh = hsh.decode()
         except:
             pass
-        fname = f".git/objects/{hsh[:2]}/{hsh[2:]}"
-        with open(fname, "rb") as f:
-            self.data = f.read()
+        raw = object_cache.get(hsh)
+        if raw is None:
+            raw = read_raw(hsh)
+            object_cache.put(hsh, *raw)
+        self.raw = raw
 
     def parse(self):
-        data = self.data
-        text = zlib.decompress(data)
-        spl = text.split(b' ', maxsplit=1)
-        assert len(spl) == 2
-        h,text = spl
-        n,rest = text.split(b'\x00', 1)
-        n = int(n)
-        assert len(rest) == n
+        h,rest = self.raw
 
         if h == b'blob':
             return GitBlob(h, rest, self.hsh)
@@ -135,4 +229,3 @@ class ObjectParser:
 
         elif h == b'commit':
             return GitCommit(h, rest, self.hsh)
-
@@ -1,17 +1,38 @@
+from rit.cache import LRUCache
+from rit.loose import object_path, loose_objects, write_file
+
 import struct
 import hashlib
+import array
 import binascii
+import bisect
+import concurrent.futures
+import itertools
 import zlib
+import mmap
+import multiprocessing
 import rit
 import os
 import sys
+import tempfile
+
+
+OBJ_TYPES = {1: b'commit', 2: b'tree', 3: b'blob', 4: b'tag'}
+
+TYPE_NUMS = {v: k for k, v in OBJ_TYPES.items()}
 
+DELTA_BASE_CACHE_SIZE = 96 * 1024 * 1024
 
-def get_int(data, obj=False):
-    a = data[0]
+INFLATE_CHUNK = 4096
+
+PARALLEL_BATCH = 256
+
+
+def get_int(data, pos, obj=False):
+    a = data[pos]
     obj_type = (a>>4) & 0b111
+    pos += 1
 
-    data = data[1:]
     cur = a
     if obj:
         size = a&0xf
@@ -19,9 +40,9 @@ def get_int(data, obj=False):
         size = a&0x7f
     n = 1
     while (1 & (cur >> 7)):
-        cur = data[0]
+        cur = data[pos]
         sz = cur&0b1111111
-        data = data[1:]
+        pos += 1
         if obj:
             sz <<= (4 + 7*(n-1))
         else:
@@ -33,91 +54,260 @@ def get_int(data, obj=False):
         for i in range(1, n):
             size += 2**(7*i)
 
-    return size, data, obj_type, n
+    return size, pos, obj_type
+
+
+def encode_type_size(obj_type, size):
+    b = bytearray()
+    cur = (obj_type << 4) | (size & 0xf)
+    size >>= 4
+    while size:
+        b.append(cur | 0x80)
+        cur = size & 0x7f
+        size >>= 7
+    b.append(cur)
+    return bytes(b)
+
+
+def obj_header(obj_type, size):
+    return OBJ_TYPES[obj_type] + f" {size}".encode() + b"\x00"
+
+
+def inflate(data, pos, keep=True):
+    zobj = zlib.decompressobj()
+    chunks = []
+    step = INFLATE_CHUNK
+    while not zobj.eof:
+        chunk = data[pos:pos+step]
+        if not chunk:
+            raise ValueError("Truncated zlib stream in packfile")
+        out = zobj.decompress(chunk)
+        if keep:
+            chunks.append(out)
+        pos += len(chunk)
+        step *= 2
+    pos -= len(zobj.unused_data)
+    return b''.join(chunks), pos
+
 
 class IndexParser:
     def __init__(self, data):
         self.data = data
 
     def parse(self):
-        data = self.data
-        header,data = data[:4], data[4:]
-        ver,data = data[:4], data[4:]
-        layer1,data = data[:1024], data[1024:]
-
-        num = struct.unpack(">I", layer1[-4:])[0]
-        layer2 = [data[20*i:20*(i+1)] for i in range(num)]
-        data = data[20*num:]
-        layer3 = [struct.unpack(">I", data[4*i:4*(i+1)])[0] for i in range(num)]
-        #print(layer3)
-        data = data[4*num:]
-        layer4 = [struct.unpack(">I", data[4*i:4*(i+1)])[0] for i in range(num)]
-        data = data[4*num:]
-        pack_chk,data = data[:20], data[20:]
-        idx_chk,data= data[:20], data[20:]
-        #print(pack_chk)
-        #print(idx_chk)
-        return Index(layer1, layer2, layer3, layer4)
-        #return zip(layer2, layer4)
+        return Index(self.data)
 
 
 class Index:
-    def __init__(self, layer1, layer2, layer3, layer4):
-        self.layer1 = layer1
-        self.layer2 = layer2
-        self.layer3 = layer3
-        self.layer4 = layer4
+    fanout_s = struct.Struct(">256I")
+    word = struct.Struct(">I")
+    large = struct.Struct(">Q")
 
+    def __init__(self, data):
+        self.data = data
+        if data[:8] != b'\xfftOc\x00\x00\x00\x02':
+            raise ValueError("Unsupported pack index version")
+        self.fanout = self.fanout_s.unpack_from(data, 8)
+        self.num = self.fanout[255]
+        self.sha_start = 8 + 1024
+        self.crc_start = self.sha_start + 20*self.num
+        self.offset_start = self.crc_start + 4*self.num
+        self.large_start = self.offset_start + 4*self.num
+
+    def __len__(self):
+        return self.num
+
+    def __getitem__(self, i):
+        start = self.sha_start + 20*i
+        return bytes(self.data[start:start+20])
+
+    def crc(self, i):
+        return self.word.unpack_from(self.data, self.crc_start + 4*i)[0]
+
+    def offset(self, i):
+        offset = self.word.unpack_from(self.data, self.offset_start + 4*i)[0]
+        if offset & 0x80000000:
+            i = offset & 0x7fffffff
+            offset = self.large.unpack_from(self.data, self.large_start + 8*i)[0]
+        return offset
+
+    def position(self, sha):
+        first = sha[0]
+        lo = self.fanout[first-1] if first else 0
+        hi = self.fanout[first]
+        i = bisect.bisect_left(self, sha, lo, hi)
+        if i < hi and self[i] == sha:
+            return i
+        return None
+
+    def lookup(self, sha):
+        i = self.position(sha)
+        if i is None:
+            return None
+        return self.offset(i)
+
+    def entries(self):
+        for i in range(self.num):
+            yield self[i], self.offset(i)
+
+    @property
+    def pack_sha(self):
+        end = len(self.data) - 20
+        return bytes(self.data[end-20:end])
+
+
+def open_index(path):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return Index(data)
+
+
+class RevIndex:
+    word = Index.word
+
+    def __init__(self, data, index):
+        self.data = data
+        self.index = index
+        if data[:12] != b'RIDX\x00\x00\x00\x01\x00\x00\x00\x01':
+            raise ValueError("Unsupported reverse index version")
 
-def create_index(objects, sha):
-    data = b'\xfftOc\x00\x00\x00\x02'
-    layer1 = [0]*256
-    for obj in objects:
-        h = obj.hash[0]
-        for i in range(h, 256):
-            layer1[i] += 1
+    def __len__(self):
+        return len(self.index)
 
-    s_objs = sorted(objects, key=lambda o: o.hash)
+    def position(self, k):
+        return self.word.unpack_from(self.data, 12 + 4*k)[0]
 
-    for i in layer1:
-        data += struct.pack(">I", i)
+    def __getitem__(self, k):
+        return self.index.offset(self.position(k))
 
-    for obj in s_objs:
-        data += obj.hash
+    def find(self, offset):
+        k = bisect.bisect_left(self, offset)
+        if k < len(self) and self[k] == offset:
+            return k
+        return None
+
+    def next_offset(self, k, pack_size):
+        if k + 1 < len(self):
+            return self[k+1]
+        return pack_size - 20
 
+
+def open_rev(path, index):
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return RevIndex(data, index)
+
+
+def be_array(typecode, items):
+    arr = array.array(typecode, items)
+    if sys.byteorder == 'little':
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def create_index(objects, sha):
+    s_objs = sorted(objects, key=lambda o: o.hash)
+    counts = [0]*256
     for obj in s_objs:
-        data += struct.pack(">I", obj.crc)
+        counts[obj.hash[0]] += 1
 
+    offsets = []
+    large = []
     for obj in s_objs:
-        data += struct.pack(">I", obj.offset)
+        if obj.offset < 0x80000000:
+            offsets.append(obj.offset)
+        else:
+            offsets.append(0x80000000 | len(large))
+            large.append(obj.offset)
+
+    data = bytearray(b'\xfftOc\x00\x00\x00\x02')
+    data += be_array('I', itertools.accumulate(counts))
+    data += b''.join(obj.hash for obj in s_objs)
+    data += be_array('I', (obj.crc for obj in s_objs))
+    data += be_array('I', offsets)
+    data += be_array('Q', large)
+    data += sha
+    data += hashlib.sha1(data).digest()
+    return bytes(data)
+
 
+def create_rev(objects, sha):
+    s_objs = sorted(objects, key=lambda o: o.hash)
+    order = sorted(range(len(s_objs)), key=lambda i: s_objs[i].offset)
+    data = bytearray(b'RIDX\x00\x00\x00\x01\x00\x00\x00\x01')
+    data += be_array('I', order)
     data += sha
     data += hashlib.sha1(data).digest()
-    return data
+    return bytes(data)
+
+
+def write_index(path, objects, sha):
+    base = os.path.splitext(path)[0]
+    index = create_index(objects, sha)
+    for ext, data in (('idx', index), ('rev', create_rev(objects, sha))):
+        fname = '.'.join((base, ext))
+        if os.path.isfile(fname):
+            os.chmod(fname, 0o644)
+        with open(fname, 'wb') as f:
+            f.write(data)
+        os.chmod(fname, 0o444)
+    return index
+
+
+def get_size(data, pos):
+    size = 0
+    shift = 0
+    while 1:
+        cur = data[pos]
+        pos += 1
+        size |= (cur & 0x7f) << shift
+        shift += 7
+        if not cur & 0x80:
+            break
+    return size, pos
 
 
 def apply_delta(delta, base):
-    output = b""
-    _, delta, _, _ = get_int(delta, obj=False)
-    _, delta, _, _ = get_int(delta, obj=False)
-    while delta:
-        inst,delta = delta[0], delta[1:]
-        action = (inst >> 7) & 1
-        if action == 1:
-            arr = [0]*7
-            for i in range(7):
+    delta = memoryview(delta)
+    base = memoryview(base)
+    base_size, pos = get_size(delta, 0)
+    size, pos = get_size(delta, pos)
+    if base_size != len(base):
+        raise ValueError(f"Delta base size mismatch: {base_size} != {len(base)}")
+    output = bytearray(size)
+    out = 0
+    end = len(delta)
+    while pos < end:
+        inst = delta[pos]
+        pos += 1
+        if inst & 0x80:
+            offset = 0
+            n = 0
+            for i in range(4):
                 if (inst >> i) & 1:
-                    arr[i],delta = delta[0],delta[1:]
-            off_arr = bytes(arr[:4])
-            siz_arr = bytes(arr[4:]) + b'\x00'
-            offset = struct.unpack("<I", off_arr)[0]
-            size = struct.unpack("<I", siz_arr)[0]
-            output += base[offset:offset+size]
-        elif action == 0:
-            num = inst & 0x7f
-            output += delta[:num]
-            delta = delta[num:]
-    return output
+                    offset |= delta[pos] << (8*i)
+                    pos += 1
+            for i in range(3):
+                if (inst >> (4+i)) & 1:
+                    n |= delta[pos] << (8*i)
+                    pos += 1
+            if n == 0:
+                n = 0x10000
+            if offset + n > base_size or out + n > size:
+                raise ValueError(f"Delta copy out of range: {offset}+{n}")
+            output[out:out+n] = base[offset:offset+n]
+        elif inst:
+            n = inst
+            if pos + n > end or out + n > size:
+                raise ValueError(f"Delta insert out of range: {n}")
+            output[out:out+n] = delta[pos:pos+n]
+            pos += n
+        else:
+            raise ValueError("Unexpected delta opcode 0")
+        out += n
+    if out != size:
+        raise ValueError(f"Delta result size mismatch: {out} != {size}")
+    return bytes(output)
 
 
 class PackfileEntry:
@@ -129,47 +319,155 @@ class PackfileEntry:
         self.unused = unused
         self.crc = 0
         self.offset = 0
+        self.base = None
+        self.ref = None
 
 
 class PackParser:
-    def __init__(self, data, index=None):
-        self.data = data
+    def __init__(self, data, index=None, cache_size=DELTA_BASE_CACHE_SIZE, fix_thin=False):
+        self.data = memoryview(data)
         self.index = index
+        self.fix_thin = fix_thin
         self.objects = []
+        self.offsets = {}
+        self.cache = LRUCache(cache_size)
+
+    def base_object(self, offset):
+        base = self.cache.get(offset)
+        if base is None:
+            e = self.parse_object(offset)
+            if e.output is None:
+                return None
+            base = (e.obj_type, e.output)
+        return base
+
+    def ref_base(self, sha):
+        offset = self.offsets.get(sha)
+        if offset is None and self.index is not None:
+            offset = self.index.lookup(sha)
+        if offset is not None:
+            return self.base_object(offset)
+        if not self.fix_thin:
+            return None
+        obj = read_object(sha)
+        if obj is None:
+            return None
+        typ, data = obj
+        return TYPE_NUMS[typ], data
 
     def parse_object(self, offset):
-        data = self.data[offset:]
-        size, data, obj_type, n = get_int(data, obj=True)
+        size, pos, obj_type = get_int(self.data, offset, obj=True)
+        base = None
         if obj_type == 6:
-            i,data,_,n1 = get_int(data, obj=False)
-            zobj = zlib.decompressobj()
-            delta = zobj.decompress(data)
-            neg_offset = offset - i
-
-            e = self.parse_object(neg_offset)
-
-            output = apply_delta(delta, e.output)
-            l = len(data) - len(zobj.unused_data)
-            entry = PackfileEntry(
-                    size, e.obj_type, output, n+n1, l)
-            d = self.data[offset:offset+n+n1+l]
-            entry.crc = zlib.crc32(d)
-            return entry
-            
-        else:
-            zobj = zlib.decompressobj()
-            output = zobj.decompress(data)
-            l = len(data) - len(zobj.unused_data)
-            entry = PackfileEntry(size, obj_type, output, n, l)
-            d = self.data[offset:offset+n+l]
-            entry.crc = zlib.crc32(d)
-            return entry
-            #return size, obj_type, output, n, len(data) - len(zobj.unused_data)
+            i,pos,_ = get_int(self.data, pos)
+            base = self.base_object(offset - i)
+        elif obj_type == 7:
+            ref = bytes(self.data[pos:pos+20])
+            pos += 20
+            base = self.ref_base(ref)
+        n = pos - offset
+        output, end = inflate(self.data, pos)
+        entry = PackfileEntry(size, obj_type, output, n, end - pos)
+        entry.crc = zlib.crc32(self.data[offset:end])
+        if obj_type in (6, 7):
+            if base is None:
+                entry.output = None
+                return entry
+            entry.obj_type, base = base
+            entry.output = apply_delta(output, base)
+        self.cache.put(offset, (entry.obj_type, entry.output), len(entry.output))
+        return entry
+
+    def set_hash(self, e):
+        out = obj_header(e.obj_type, len(e.output)) + e.output
+        e.hash = hashlib.sha1(out).digest()
+        e.obj_data = out
+        self.offsets[e.hash] = e.offset
+
+    def resolve_pending(self, pending):
+        while pending:
+            deferred = []
+            for e in pending:
+                obj = self.parse_object(e.offset)
+                if obj.output is None:
+                    deferred.append(e)
+                    continue
+                e.obj_type = obj.obj_type
+                e.output = obj.output
+                self.set_hash(e)
+            if len(deferred) == len(pending):
+                raise ValueError(f"pack has {len(deferred)} unresolved deltas")
+            pending = deferred
+
+    def scan(self):
+        numobj = struct.unpack_from(">I", self.data, 8)[0]
+        objects = []
+        offset = 12
+        for _ in range(numobj):
+            size, pos, obj_type = get_int(self.data, offset, obj=True)
+            base = None
+            ref = None
+            if obj_type == 6:
+                i,pos,_ = get_int(self.data, pos)
+                base = offset - i
+            elif obj_type == 7:
+                ref = bytes(self.data[pos:pos+20])
+                pos += 20
+            _, end = inflate(self.data, pos, keep=False)
+            entry = PackfileEntry(size, obj_type, None, pos - offset, end - pos)
+            entry.offset = offset
+            entry.base = base
+            entry.ref = ref
+            entry.crc = zlib.crc32(self.data[offset:end])
+            objects.append(entry)
+            offset = end
+        return objects
+
+    def parse_parallel(self, path, threads):
+        objects = self.scan()
+        by_offset = {}
+        children = {}
+        for e in objects:
+            by_offset[e.offset] = e
+            if e.base is not None:
+                children.setdefault(e.base, []).append(e.offset)
+
+        families = []
+        leaves = []
+        for e in objects:
+            if e.obj_type in (6, 7):
+                continue
+            if e.offset not in children:
+                leaves.append(e.offset)
+                continue
+            family = [e.offset]
+            i = 0
+            while i < len(family):
+                family += children.get(family[i], [])
+                i += 1
+            families.append(family)
+        families.sort(key=len, reverse=True)
+        step = PARALLEL_BATCH
+        tasks = families + [leaves[i:i+step] for i in range(0, len(leaves), step)]
+
+        with multiprocessing.Pool(threads, _init_worker, (path,)) as pool:
+            for result in pool.imap_unordered(_parse_offsets, tasks):
+                for offset, obj_type, h in result:
+                    e = by_offset[offset]
+                    e.obj_type = obj_type
+                    e.hash = h
+                    self.offsets[h] = offset
+        self.resolve_pending([e for e in objects if e.obj_type in (6, 7)])
+        for e in objects:
+            e.output = None
+            e.obj_data = None
+        self.sha = bytes(self.data[-20:])
+        self.objects = objects
 
     def parse_without_index(self):
         header = self.data[:4]
         version = self.data[4:8]
-        numobj = struct.unpack(">I", self.data[8:12])[0]
+        numobj = struct.unpack_from(">I", self.data, 8)[0]
 
         #print(header)
         #print(version)
@@ -177,6 +475,7 @@ class PackParser:
         #print("*"*30)
 
         objects = []
+        pending = []
         offset = 12
         for _ in range(numobj):
             #print(offset)
@@ -185,37 +484,25 @@ class PackParser:
             e.offset = offset
             offset += e.unused + e.n
             objects.append(e)
-            #objects.append((e.output, e.obj_type, offset, e.crc))
-
-        new_objects = []
-        #for output, o, offset, crc in objects:
-        for obj in objects:
-            o = obj.obj_type
-            l = len(obj.output)
-            if o == 1:
-                out = f"commit {l}".encode() + b"\x00"
-            # tree
-            elif o == 2:
-                out = f"tree {l}".encode() + b"\x00"
-            # blob
-            elif o == 3:
-                out = f"blob {l}".encode() + b"\x00"
-            out += obj.output
-            h = hashlib.sha1(out).digest()
-            obj.hash = h
-            obj.obj_data = out
-            #new_objects.append((h, out, offset, crc))
-        sha = self.data[-20:]
+            if e.output is None:
+                pending.append(e)
+            else:
+                self.set_hash(e)
+        self.resolve_pending(pending)
+        sha = bytes(self.data[-20:])
         self.sha = sha
         self.objects = objects
     
     def create_index(self):
         return create_index(self.objects, self.sha)
+
+    def write_index(self, path):
+        return write_index(path, self.objects, self.sha)
  
     def parse_with_index(self):
         header = self.data[:4]
         version = self.data[4:8]
-        numobj = struct.unpack(">I", self.data[8:12])[0]
+        numobj = struct.unpack_from(">I", self.data, 8)[0]
 
         #print(header)
         #print(version)
@@ -228,8 +515,7 @@ class PackParser:
         if not self.index:
             return
     
-        z = zip(self.index.layer2, self.index.layer4)
-        for item, offset in z:
+        for item, offset in self.index.entries():
             offsets.append(offset)
             e = self.parse_object(offset)
             e.hash = item
@@ -237,46 +523,383 @@ class PackParser:
 
             #_,o,output,_,_ = self.parse_object(offset)
             #self.objects.append((item, e.output, e.obj_type))
-        self.sha = self.data[-20:]
-
-    def write_objects(self, objdir):
-        #for hsh, output, o in self.objects:
-        total = len(self.objects)
-        i = 1
-        for obj in self.objects:
-            pct = int(100*i/total)
-            sys.stdout.write(f"\rUnpacking objects: {pct}% ({i}/{total}),")
-            #sys.stdout.flush()
-            i += 1
-            hsh = obj.hash
-            output = obj.output
-            o = obj.obj_type
-            l = len(output)
-            # commit
-            if o == 1:
-                out = f"commit {l}".encode() + b"\x00"
-            # tree
-            elif o == 2:
-                out = f"tree {l}".encode() + b"\x00"
-            # blob
-            elif o == 3:
-                out = f"blob {l}".encode() + b"\x00"
-            out += output
-            _h = hashlib.sha1(out).digest()
-            assert _h == hsh
-            z = zlib.compress(out)
-            
-            h = binascii.hexlify(_h).decode()
-            path = os.path.join(objdir, h[:2], h[2:])
-            dirname = os.path.dirname(path)
-
-            if not os.path.isdir(dirname):
-                os.mkdir(dirname)
-            if os.path.isfile(path):
-                os.chmod(path, 0o644)
-            with open(path, "wb") as f:
-                f.write(z)
-            os.chmod(path, 0o444)
+        self.sha = bytes(self.data[-20:])
+
+    def write_objects(self, objdir, threads=None):
+        if self.index is not None:
+            entries = list(self.index.entries())
+        else:
+            entries = [(obj.hash, obj.offset) for obj in self.objects]
+        entries.sort(key=lambda e: e[1])
+        prefixes = {binascii.hexlify(sha[:1]).decode() for sha, _ in entries}
+        present = loose_objects(objdir, prefixes)
+
+        total = len(entries)
+        pct = -1
+        window = []
+        workers = threads or min(32, (os.cpu_count() or 1) + 4)
+        limit = 4 * workers
+        with concurrent.futures.ThreadPoolExecutor(workers) as pool:
+            for i, (sha, offset) in enumerate(entries, 1):
+                if binascii.hexlify(sha).decode() not in present:
+                    obj_type, output = self.base_object(offset)
+                    path = object_path(objdir, sha)
+                    window.append(pool.submit(write_loose, path, obj_type, output))
+                    if len(window) > limit:
+                        window.pop(0).result()
+                if int(100*i/total) != pct:
+                    pct = int(100*i/total)
+                    sys.stdout.write(f"\rUnpacking objects: {pct}% ({i}/{total}),")
+            for future in window:
+                future.result()
         sys.stdout.write(' done.\n')
 
 
+def write_loose(path, obj_type, output):
+    z = zlib.compress(obj_header(obj_type, len(output)) + output)
+    write_file(path, z)
+
+
+_worker = None
+
+
+def _init_worker(path):
+    global _worker
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    _worker = PackParser(data)
+
+
+def _parse_offsets(offsets):
+    result = []
+    for offset in offsets:
+        e = _worker.parse_object(offset)
+        h = hashlib.sha1(obj_header(e.obj_type, len(e.output)))
+        h.update(e.output)
+        result.append((offset, e.obj_type, h.digest()))
+    return result
+
+
+class PackWriter:
+    def __init__(self, packdir):
+        self.packdir = packdir
+        fd, self.tmp = tempfile.mkstemp(prefix='tmp_pack_', dir=packdir)
+        self.f = os.fdopen(fd, 'wb')
+        self.sha = hashlib.sha1()
+        self.tail = b''
+        self.size = 0
+
+    def write(self, data):
+        self.f.write(data)
+        self.size += len(data)
+        if len(data) >= 20:
+            self.sha.update(self.tail)
+            self.sha.update(data[:-20])
+            self.tail = bytes(data[-20:])
+        else:
+            buf = self.tail + bytes(data)
+            self.sha.update(buf[:-20])
+            self.tail = buf[-20:]
+
+    def abort(self):
+        self.f.close()
+        try:
+            os.remove(self.tmp)
+        except FileNotFoundError:
+            pass
+
+    def finish(self):
+        if self.size < 32 or self.sha.digest() != self.tail:
+            self.abort()
+            raise ValueError("Pack checksum mismatch")
+        self.f.close()
+        h = binascii.hexlify(self.tail).decode()
+        path = os.path.join(self.packdir, f'pack-{h}.pack')
+        os.rename(self.tmp, path)
+        os.chmod(path, 0o444)
+        return path
+
+
+class PackIndexer(PackWriter):
+    def __init__(self, packdir, cache_size=DELTA_BASE_CACHE_SIZE):
+        super().__init__(packdir)
+        self.buf = bytearray()
+        self.offset = 0
+        self.numobj = None
+        self.objects = []
+        self.offsets = {}
+        self.pending = []
+        self.unresolved = set()
+        self.thin = {}
+        self.cache = LRUCache(cache_size)
+        self.cur = None
+        self.reader = None
+        self.reader_size = 0
+
+    def write(self, data):
+        super().write(data)
+        self.buf += data
+        while self.consume():
+            pass
+
+    def consume(self):
+        if self.numobj is None:
+            if len(self.buf) < 12:
+                return False
+            if self.buf[:4] != b'PACK':
+                raise ValueError("Not a packfile")
+            self.numobj = struct.unpack_from(">I", self.buf, 8)[0]
+            del self.buf[:12]
+            self.offset = 12
+        if self.cur is None:
+            if len(self.objects) == self.numobj:
+                return False
+            return self.start_object()
+        return self.inflate()
+
+    def start_object(self):
+        try:
+            size, pos, obj_type = get_int(self.buf, 0, obj=True)
+            base = None
+            ref = None
+            if obj_type == 6:
+                i,pos,_ = get_int(self.buf, pos)
+                base = self.offset - i
+        except IndexError:
+            return False
+        if obj_type == 7:
+            if len(self.buf) < pos + 20:
+                return False
+            ref = bytes(self.buf[pos:pos+20])
+            pos += 20
+        entry = PackfileEntry(size, obj_type, None, pos, 0)
+        entry.offset = self.offset
+        entry.base = base
+        entry.ref = ref
+        entry.crc = zlib.crc32(self.buf[:pos])
+        sha = None
+        if obj_type not in (6, 7):
+            sha = hashlib.sha1(obj_header(obj_type, size))
+        self.cur = (entry, zlib.decompressobj(), [], sha)
+        del self.buf[:pos]
+        self.offset += pos
+        return True
+
+    def inflate(self):
+        entry, zobj, chunks, sha = self.cur
+        out = zobj.decompress(self.buf)
+        used = len(self.buf) - len(zobj.unused_data)
+        entry.crc = zlib.crc32(memoryview(self.buf)[:used], entry.crc)
+        entry.unused += used
+        del self.buf[:used]
+        self.offset += used
+        if sha is not None:
+            sha.update(out)
+        if sha is None or entry.size <= self.cache.budget:
+            chunks.append(out)
+        if not zobj.eof:
+            return False
+
+        self.objects.append(entry)
+        self.cur = None
+        output = b''.join(chunks)
+        if sha is None:
+            entry.output = output
+            if not self.resolve(entry):
+                self.pending.append(entry)
+            return True
+        entry.hash = sha.digest()
+        self.offsets[entry.hash] = entry.offset
+        if len(output) == entry.size:
+            self.cache.put(entry.offset, (entry.obj_type, output), len(output))
+        return True
+
+    def resolve(self, entry, local=False):
+        base = None
+        if entry.ref is not None:
+            offset = self.offsets.get(entry.ref)
+            if offset is not None:
+                base = self.base_object(offset)
+            elif local:
+                obj = read_object(entry.ref)
+                if obj is not None:
+                    typ, data = obj
+                    base = (TYPE_NUMS[typ], data)
+                    self.thin[entry.ref] = None
+        elif entry.base not in self.unresolved:
+            base = self.base_object(entry.base)
+        if base is None:
+            self.unresolved.add(entry.offset)
+            return False
+        entry.obj_type, base = base
+        output = apply_delta(entry.output, base)
+        entry.output = None
+        entry.hash = hashlib.sha1(obj_header(entry.obj_type, len(output)) + output).digest()
+        self.unresolved.discard(entry.offset)
+        self.offsets[entry.hash] = entry.offset
+        self.cache.put(entry.offset, (entry.obj_type, output), len(output))
+        return True
+
+    def base_object(self, offset):
+        base = self.cache.get(offset)
+        if base is not None:
+            return base
+        if self.reader is None or self.reader_size < self.offset:
+            self.f.flush()
+            with open(self.tmp, 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.reader = PackParser(data, fix_thin=True)
+            self.reader.cache = self.cache
+            self.reader.offsets = self.offsets
+            self.reader_size = len(data)
+        return self.reader.base_object(offset)
+
+    def finish(self, fix_thin=False):
+        if self.numobj is None or self.cur or len(self.objects) != self.numobj:
+            self.abort()
+            raise ValueError("Truncated packfile")
+        pending = self.pending
+        local = False
+        while pending:
+            deferred = [e for e in pending if not self.resolve(e, local)]
+            if len(deferred) == len(pending):
+                if local or not fix_thin:
+                    self.abort()
+                    raise ValueError(f"pack has {len(deferred)} unresolved deltas")
+                local = True
+            pending = deferred
+        path = super().finish()
+        if self.thin:
+            path = self.fix_thin(path)
+        self.index = write_index(path, self.objects, self.tail)
+        return path
+
+    def fix_thin(self, path):
+        os.chmod(path, 0o644)
+        with open(path, 'r+b') as f:
+            f.seek(-20, os.SEEK_END)
+            f.truncate()
+            offset = f.tell()
+            for sha in self.thin:
+                typ, data = read_object(sha)
+                obj_type = TYPE_NUMS[typ]
+                header = encode_type_size(obj_type, len(data))
+                raw = header + zlib.compress(data)
+                f.write(raw)
+                entry = PackfileEntry(
+                        len(data), obj_type, None, len(header), len(raw) - len(header))
+                entry.offset = offset
+                entry.crc = zlib.crc32(raw)
+                entry.hash = sha
+                self.objects.append(entry)
+                offset += len(raw)
+            f.seek(8)
+            f.write(struct.pack(">I", len(self.objects)))
+            f.seek(0)
+            h = hashlib.sha1()
+            while 1:
+                chunk = f.read(1 << 20)
+                if not chunk:
+                    break
+                h.update(chunk)
+            self.tail = h.digest()
+            f.write(self.tail)
+        h = binascii.hexlify(self.tail).decode()
+        newpath = os.path.join(self.packdir, f'pack-{h}.pack')
+        os.rename(path, newpath)
+        os.chmod(newpath, 0o444)
+        return newpath
+
+
+class Pack:
+    def __init__(self, base):
+        self.base = base
+        self.index = open_index(f"{base}.idx")
+        with open(f"{base}.pack", 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.parser = PackParser(self.data, index=self.index)
+        self._rev = None
+
+    @property
+    def rev(self):
+        if self._rev is None:
+            path = f"{self.base}.rev"
+            if not os.path.isfile(path):
+                objects = []
+                for i in range(len(self.index)):
+                    e = PackfileEntry(0, 0, None, 0, 0)
+                    e.hash = self.index[i]
+                    e.offset = self.index.offset(i)
+                    objects.append(e)
+                data = create_rev(objects, self.index.pack_sha)
+                self._rev = RevIndex(data, self.index)
+            else:
+                self._rev = open_rev(path, self.index)
+        return self._rev
+
+    def find(self, sha):
+        return self.index.lookup(sha)
+
+    def object_at(self, offset):
+        k = self.rev.find(offset)
+        if k is None:
+            return None
+        return self.index[self.rev.position(k)]
+
+    def disk_size(self, sha):
+        i = self.index.position(sha)
+        if i is None:
+            return None
+        offset = self.index.offset(i)
+        k = self.rev.find(offset)
+        return self.rev.next_offset(k, len(self.data)) - offset
+
+    def read(self, offset):
+        obj_type, output = self.parser.base_object(offset)
+        return OBJ_TYPES[obj_type], output
+
+
+packs = {}
+
+
+def load_packs(packdir=os.path.join('.git', 'objects', 'pack')):
+    if not os.path.isdir(packdir):
+        return
+    for fname in sorted(os.listdir(packdir)):
+        base,ext = os.path.splitext(fname)
+        base = os.path.join(packdir, base)
+        if ext != '.idx' or base in packs:
+            continue
+        if os.path.isfile(f"{base}.pack"):
+            packs[base] = Pack(base)
+
+
+def read_object(sha):
+    hsh = binascii.hexlify(sha).decode()
+    path = os.path.join('.git', 'objects', hsh[:2], hsh[2:])
+    if os.path.isfile(path):
+        with open(path, 'rb') as f:
+            text = zlib.decompress(f.read())
+        typ,text = text.split(b' ', maxsplit=1)
+        _,data = text.split(b'\x00', maxsplit=1)
+        return typ, data
+    return read_packed(hsh)
+
+
+def find_packed(sha, rescan=True):
+    for scan in ((False, True) if rescan else (False,)):
+        if scan:
+            load_packs()
+        for pack in packs.values():
+            offset = pack.find(sha)
+            if offset is not None:
+                return pack, offset
+    return None
+
+
+def read_packed(hsh):
+    found = find_packed(binascii.unhexlify(hsh))
+    if found is None:
+        return None
+    pack, offset = found
+    return pack.read(offset)
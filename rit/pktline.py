@@ -0,0 +1,38 @@
+import sys
+
+
+def read_exact(stream, n):
+    data = stream.read(n)
+    while len(data) < n:
+        chunk = stream.read(n - len(data))
+        if not chunk:
+            raise EOFError(f"Expected {n} bytes, got {len(data)}")
+        data += chunk
+    return data
+
+
+def read_pkt_line(stream):
+    head = stream.read(4)
+    if not head:
+        return None
+    if len(head) < 4:
+        head += read_exact(stream, 4 - len(head))
+    n = int(head, 16)
+    if n == 0:
+        return b''
+    return read_exact(stream, n - 4)
+
+
+def demux(stream, pack, progress=sys.stdout):
+    while 1:
+        msg = read_pkt_line(stream)
+        if not msg:
+            break
+        band = msg[0]
+        if band == 1:
+            pack.write(memoryview(msg)[1:])
+        elif band == 2:
+            progress.write(msg[1:].decode(errors='replace'))
+            progress.flush()
+        elif band == 3:
+            raise Exception(f"remote error: {msg[1:].decode(errors='replace')}")
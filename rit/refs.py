@@ -0,0 +1,193 @@
+from rit.objects import read_raw
+from rit.lockfile import write_locked
+
+import os
+
+
+GIT = '.git'
+PACKED_HEADER = "# pack-refs with: peeled fully-peeled sorted \n"
+
+
+def peel(hsh):
+    obj_type, data = read_raw(hsh)
+    while obj_type == b'tag':
+        hsh = data[7:47].decode()
+        obj_type, data = read_raw(hsh)
+    return hsh
+
+
+def read_packed_refs(path):
+    refs = {}
+    peeled = {}
+    fully_peeled = False
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except FileNotFoundError:
+        return refs, peeled, fully_peeled
+    name = None
+    for line in lines:
+        if line.startswith('# pack-refs with:'):
+            fully_peeled = 'fully-peeled' in line.split(':', 1)[1].split()
+            continue
+        if not line or line.startswith('#'):
+            continue
+        if line.startswith('^'):
+            peeled[name] = line[1:]
+            continue
+        hsh, name = line.split(' ', 1)
+        refs[name] = hsh
+    return refs, peeled, fully_peeled
+
+
+def write_packed_refs(path, refs, peeled):
+    lines = [PACKED_HEADER]
+    for name in sorted(refs):
+        lines.append(f"{refs[name]} {name}\n")
+        if name in peeled:
+            lines.append(f"^{peeled[name]}\n")
+    write_locked(path, ''.join(lines).encode())
+
+
+class RefStore:
+    def __init__(self, gitdir=GIT):
+        self.gitdir = gitdir
+        self.packed_path = os.path.join(gitdir, 'packed-refs')
+        self._head = None
+        self._loose = None
+        self._packed = None
+        self._peeled = None
+        self._fully_peeled = False
+
+    def load_packed(self):
+        if self._packed is None:
+            self._packed, self._peeled, self._fully_peeled = read_packed_refs(self.packed_path)
+        return self._packed
+
+    def peel_packed(self, names):
+        for name in names:
+            self._peeled.pop(name, None)
+            target = peel(self._packed[name])
+            if target != self._packed[name]:
+                self._peeled[name] = target
+
+    def load_loose(self):
+        if self._loose is None:
+            self._loose = {}
+            refdir = os.path.join(self.gitdir, 'refs')
+            for dname, dirs, files in os.walk(refdir):
+                for fname in files:
+                    full = os.path.join(dname, fname)
+                    name = os.path.relpath(full, self.gitdir)
+                    with open(full) as f:
+                        hsh = f.read().strip()
+                    if hsh:
+                        self._loose[name] = hsh
+        return self._loose
+
+    def refs(self):
+        refs = dict(self.load_packed())
+        refs.update(self.load_loose())
+        return refs
+
+    def head(self):
+        if self._head is None:
+            with open(os.path.join(self.gitdir, 'HEAD')) as f:
+                self._head = f.read().strip()
+        if self._head.startswith('ref:'):
+            return self._head[4:].strip()
+        return self._head
+
+    def resolve(self, ref):
+        ref = ref.strip('/')
+        loose = self.load_loose()
+        if ref in loose:
+            return loose[ref]
+        return self.load_packed().get(ref, '')
+
+    def peeled(self, ref):
+        hsh = self.resolve(ref)
+        if not hsh:
+            return hsh
+        if self.load_packed().get(ref) == hsh:
+            if ref in self._peeled:
+                return self._peeled[ref]
+            # A fully-peeled packed-refs file records a ^ line for every
+            # ref that peels to something else.
+            if self._fully_peeled:
+                return hsh
+        if ref.startswith('refs/tags/'):
+            return peel(hsh)
+        return hsh
+
+    def branches(self):
+        prefix = 'refs/heads/'
+        return sorted(n[len(prefix):] for n in self.refs() if n.startswith(prefix))
+
+    def set_head(self, ref):
+        with open(os.path.join(self.gitdir, 'HEAD'), 'w') as f:
+            f.write(f"ref: {ref}")
+        self._head = f"ref: {ref}"
+
+    def update(self, ref, hsh):
+        path = os.path.join(self.gitdir, ref)
+        dirname = os.path.dirname(path)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(path, 'w') as f:
+            f.write(hsh + '\n')
+        self.load_loose()[ref] = hsh
+
+    def delete(self, ref):
+        found = False
+        loose = self.load_loose()
+        if ref in loose:
+            os.remove(os.path.join(self.gitdir, ref))
+            del loose[ref]
+            found = True
+        packed = self.load_packed()
+        if ref in packed:
+            del packed[ref]
+            self._peeled.pop(ref, None)
+            if not self._fully_peeled:
+                self.peel_packed(packed)
+                self._fully_peeled = True
+            write_packed_refs(self.packed_path, packed, self._peeled)
+            found = True
+        return found
+
+    def pack(self, everything=False):
+        packed = self.load_packed()
+        loose = self.load_loose()
+        moved = []
+        for name, hsh in loose.items():
+            if not everything and not name.startswith('refs/tags/'):
+                continue
+            packed[name] = hsh
+            moved.append(name)
+        self.peel_packed(moved if self._fully_peeled else packed)
+        self._fully_peeled = True
+        write_packed_refs(self.packed_path, packed, self._peeled)
+        refdir = os.path.join(self.gitdir, 'refs')
+        for name in moved:
+            path = os.path.join(self.gitdir, name)
+            os.remove(path)
+            del loose[name]
+            dirname = os.path.dirname(path)
+            while dirname != refdir and dirname.startswith(refdir):
+                try:
+                    os.rmdir(dirname)
+                except OSError:
+                    break
+                dirname = os.path.dirname(dirname)
+        return len(moved)
+
+
+_store = None
+
+
+def ref_store():
+    global _store
+    if _store is None:
+        _store = RefStore()
+    return _store
@@ -0,0 +1,84 @@
+from rit.objects import ObjectParser
+from rit.commitgraph import load_commit_graph
+
+import datetime
+import heapq
+import re
+import time
+
+
+UNITS = {
+        'second': 1,
+        'minute': 60,
+        'hour': 3600,
+        'day': 86400,
+        'week': 7*86400,
+        'month': 30*86400,
+        'year': 365*86400,
+        }
+
+
+def parse_date(s):
+    s = s.strip()
+    if s.isdigit():
+        return int(s)
+    if s == 'now':
+        return int(time.time())
+    m = re.fullmatch(r'(\d+)[ .]?(second|minute|hour|day|week|month|year)s?[ .]?ago', s)
+    if m:
+        return int(time.time()) - int(m.group(1)) * UNITS[m.group(2)]
+    try:
+        return int(datetime.datetime.fromisoformat(s).timestamp())
+    except ValueError:
+        raise ValueError(f"Invalid date: {s}")
+
+
+def commit_parents(hsh, commit=None):
+    graph = load_commit_graph()
+    if graph is not None:
+        parents = graph.parents(hsh)
+        if parents is not None:
+            return parents
+    if commit is None:
+        commit = ObjectParser(hsh).parse()
+    return commit.parents
+
+
+def commit_date(hsh):
+    graph = load_commit_graph()
+    if graph is not None:
+        date = graph.date(hsh)
+        if date is not None:
+            return date
+    return ObjectParser(hsh).parse().date
+
+
+def walk(tips, limit=None, since=None, until=None, first_parent=False):
+    heap = []
+    seen = set()
+    seq = 0
+    for hsh in tips:
+        if hsh and hsh not in seen:
+            seen.add(hsh)
+            heapq.heappush(heap, (-commit_date(hsh), seq, hsh))
+            seq += 1
+
+    count = 0
+    while heap:
+        if limit is not None and count >= limit:
+            return
+        date, _, hsh = heapq.heappop(heap)
+        date = -date
+        if since is not None and date < since:
+            return
+        if until is None or date <= until:
+            yield hsh
+            count += 1
+        parents = commit_parents(hsh)
+        if first_parent:
+            parents = parents[:1]
+        for p in parents:
+            if p not in seen:
+                seen.add(p)
+                heapq.heappush(heap, (-commit_date(p), seq, p))
+                seq += 1
@@ -0,0 +1,325 @@
+from rit.index import IndexWrapper, file_mode
+from rit.ignore import exclude_matcher
+from rit import fsmonitor
+
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+import zlib
+
+
+HASH_CHUNK = 1 << 20
+UNTRACKED_CACHE = os.path.join('.git', 'untracked-cache')
+RACY_NS = 1000000000
+PARALLEL_MIN = 64
+
+
+def hash_file(path, stat):
+    if (stat.st_mode & 0o170000) == 0o120000:
+        data = os.readlink(path).encode()
+        return hashlib.sha1(f"blob {len(data)}\0".encode() + data).digest()
+    h = hashlib.sha1(f"blob {stat.st_size}\0".encode())
+    with open(path, 'rb') as f:
+        while 1:
+            chunk = f.read(HASH_CHUNK)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.digest()
+
+
+def rehash(item):
+    entry, path, stat = item
+    try:
+        return entry, stat, hash_file(path, stat)
+    except FileNotFoundError:
+        return entry, None, None
+
+
+def blob_object(item):
+    path, is_link, known = item
+    if is_link:
+        data = os.readlink(path).encode()
+    else:
+        with open(path, 'rb') as f:
+            data = f.read()
+    blob = f"blob {len(data)}\0".encode() + data
+    sha1 = hashlib.sha1(blob).digest()
+    if sha1 == known:
+        return path, sha1, None
+    return path, sha1, zlib.compress(blob)
+
+
+def under(path, prefixes):
+    for prefix in prefixes:
+        if not prefix or path == prefix or path.startswith(prefix + '/'):
+            return True
+    return False
+
+
+def stage_paths(iw, files, dirs, writer, changed=None, processes=None):
+    index = iw.index
+    index_mtime = iw.mtime()
+    candidates = set(files)
+    if dirs:
+        tracked = {name.decode() for name in index.names}
+        for path in tracked:
+            if under(path, dirs) and (changed is None or reported(path, changed)):
+                candidates.add(path)
+        candidates.update(untracked_paths(tracked, changed, roots=dirs))
+
+    jobs = []
+    stats = {}
+    modified = False
+    for path in sorted(candidates):
+        e = index.get(path.encode())
+        try:
+            stat = os.lstat(path)
+        except FileNotFoundError:
+            if e is not None:
+                modified |= index.remove_entry(e.entry_path_name)
+            continue
+        if e is not None and e.stat_matches(stat) and not e.racily_clean(index_mtime):
+            continue
+        stats[path] = stat
+        is_link = (stat.st_mode & 0o170000) == 0o120000
+        jobs.append((path, is_link, e.sha1 if e is not None else None))
+
+    if len(jobs) < PARALLEL_MIN or processes == 1:
+        results = map(blob_object, jobs)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(processes)
+        results = pool.imap_unordered(blob_object, jobs, chunksize=16)
+    try:
+        for path, sha1, zipped in results:
+            if zipped is not None:
+                writer.write(sha1, zipped)
+            stat = stats[path]
+            index.add_entry(file_mode(stat), sha1, path, stat=stat)
+            modified = True
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return modified
+
+
+def reported(path, changed):
+    while path:
+        if path in changed:
+            return True
+        path = os.path.dirname(path)
+    return False
+
+
+def unstaged_changes(iw=None, threads=None, changed=None, token=None):
+    if iw is None:
+        iw = IndexWrapper()
+    index_mtime = iw.mtime()
+    dirty = False
+    if changed is not None:
+        changed = changed | fsmonitor.index_dirty(iw.index)
+    results = []
+    suspects = []
+    for e in iw.index.entries:
+        path = e.entry_path_name.decode()
+        if changed is not None and not reported(path, changed):
+            continue
+        try:
+            stat = os.lstat(path)
+        except FileNotFoundError:
+            results.append(("deleted", path))
+            continue
+        if e.assume_valid:
+            continue
+        if e.mode != file_mode(stat):
+            results.append(("modified", path))
+            continue
+        if e.stat_matches(stat) and not e.racily_clean(index_mtime):
+            continue
+        if e.size != stat.st_size & 0xffffffff and e.size:
+            results.append(("modified", path))
+            continue
+        suspects.append((e, path, stat))
+
+    refreshed = 0
+    if suspects:
+        with concurrent.futures.ThreadPoolExecutor(threads) as pool:
+            for e, stat, sha1 in pool.map(rehash, suspects):
+                path = e.entry_path_name.decode()
+                if stat is None:
+                    results.append(("deleted", path))
+                elif sha1 != e.sha1:
+                    results.append(("modified", path))
+                else:
+                    # Content is unchanged: record the fresh stat data so
+                    # the next run can trust it without reading the file.
+                    e.set_stat(stat)
+                    refreshed += 1
+
+    results.sort(key=lambda x: x[1])
+    if token is not None:
+        # Paths still dirty now must be examined again next time even if
+        # the monitor reports nothing new for them.
+        fsmonitor.set_index_token(iw.index, token, [p for _, p in results])
+        dirty = True
+    if refreshed or dirty:
+        iw.write()
+    return results
+
+
+def ignore_key(path, parent_key):
+    try:
+        st = os.stat(path)
+        own = f"{st.st_mtime_ns}:{st.st_size}"
+    except (FileNotFoundError, NotADirectoryError):
+        own = '-'
+    return hashlib.sha1(f"{parent_key}|{own}".encode()).hexdigest()[:16]
+
+
+def load_untracked_cache():
+    try:
+        with open(UNTRACKED_CACHE) as f:
+            cache = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return {}
+    if cache.get('version') != 1:
+        return {}
+    return cache['dirs']
+
+
+def save_untracked_cache(dirs):
+    lock = UNTRACKED_CACHE + '.lock'
+    with open(lock, 'w') as f:
+        json.dump({'version': 1, 'dirs': dirs}, f, separators=(',', ':'))
+    os.replace(lock, UNTRACKED_CACHE)
+
+
+def untracked_paths(tracked, changed=None, roots=('',)):
+    matchers = {}
+
+    def matcher_for(d):
+        if d not in matchers:
+            if d:
+                parent = matcher_for(os.path.dirname(d))
+            else:
+                parent = exclude_matcher()
+            matchers[d] = parent.child(d)
+        return matchers[d]
+
+    cache = load_untracked_cache()
+    new = {}
+    start = time.time_ns()
+    found = []
+    root_key = ignore_key(os.path.join('.git', 'info', 'exclude'), '')
+    if changed is not None:
+        touched = set()
+        for path in changed:
+            touched.add(path)
+            touched.add(os.path.dirname(path))
+    roots = sorted(set(roots))
+    roots = [d for i, d in enumerate(roots) if not under(d, roots[:i])]
+    if roots != ['']:
+        # Only the requested subtrees are scanned; cached listings for the
+        # rest of the worktree are kept as they are.
+        new = {d: e for d, e in cache.items() if not under(d, roots)}
+    stack = []
+    for root in roots:
+        d = ''
+        key = ignore_key('.gitignore', root_key)
+        for name in root.split('/') if root else []:
+            rel = f"{d}/{name}" if d else name
+            if rel == '.git' or matcher_for(d).ignored(rel, True):
+                break
+            key = ignore_key(os.path.join(rel, '.gitignore'), key)
+            d = rel
+        else:
+            stack.append((root, key, False))
+    while stack:
+        d, key, trusted = stack.pop()
+        entry = cache.get(d)
+        if trusted and entry is not None and d not in touched:
+            # The monitor saw nothing here, so the cached listing stands
+            # without a stat call.
+            new[d] = entry
+            for name in entry[2]:
+                rel = f"{d}/{name}" if d else name
+                if rel not in tracked:
+                    found.append(rel)
+            for name in entry[3]:
+                rel = f"{d}/{name}" if d else name
+                sub = cache.get(rel)
+                if sub is not None and rel not in touched:
+                    stack.append((rel, sub[1], True))
+                else:
+                    stack.append((rel, ignore_key(os.path.join(rel, '.gitignore'), key), False))
+            continue
+        try:
+            st = os.stat(d or '.')
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        if entry is None or entry[0] != st.st_mtime_ns or entry[1] != key:
+            m = matcher_for(d)
+            files = []
+            dirs = []
+            with os.scandir(d or '.') as it:
+                for de in it:
+                    rel = f"{d}/{de.name}" if d else de.name
+                    if rel == '.git':
+                        continue
+                    is_dir = de.is_dir(follow_symlinks=False)
+                    if m.ignored(rel, is_dir):
+                        continue
+                    if is_dir:
+                        dirs.append(de.name)
+                    else:
+                        files.append(de.name)
+            entry = [st.st_mtime_ns, key, sorted(files), sorted(dirs)]
+        # A directory touched within the timestamp granularity of this
+        # scan could change again without its mtime moving.
+        if st.st_mtime_ns + RACY_NS < start:
+            new[d] = entry
+        for name in entry[2]:
+            rel = f"{d}/{name}" if d else name
+            if rel not in tracked:
+                found.append(rel)
+        recomputed = cache.get(d) is not entry
+        for name in entry[3]:
+            rel = f"{d}/{name}" if d else name
+            child_key = ignore_key(os.path.join(rel, '.gitignore'), key)
+            sub = cache.get(rel)
+            trusted = (changed is not None and not recomputed and
+                    sub is not None and sub[1] == child_key)
+            stack.append((rel, child_key, trusted))
+
+    if new != cache:
+        save_untracked_cache(new)
+    return found
+
+
+def untracked_files(tracked=None, changed=None):
+    if tracked is None:
+        tracked = {e.entry_path_name.decode() for e in IndexWrapper().index.entries}
+    tracked_dirs = set()
+    for path in tracked:
+        d = os.path.dirname(path)
+        while d and d not in tracked_dirs:
+            tracked_dirs.add(d)
+            d = os.path.dirname(d)
+
+    found = untracked_paths(tracked, changed)
+    results = set()
+    for path in found:
+        parts = path.split('/')
+        for i in range(1, len(parts)):
+            prefix = '/'.join(parts[:i])
+            if prefix not in tracked_dirs:
+                results.add(prefix + '/')
+                break
+        else:
+            results.add(path)
+    return sorted(results)